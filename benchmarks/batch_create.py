@@ -0,0 +1,63 @@
+"""Benchmark batch task creation against creating tasks one at a time.
+
+Both ways go through the service layer with questions only, so what is
+measured is the cost of writing the tasks, not of indexing or answering.
+
+Usage: `python benchmarks/batch_create.py [--tasks 1000] [--shards 1]`
+"""
+
+import argparse
+import importlib
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "source"))
+
+models = importlib.import_module("5dai.models.tasks")
+services = importlib.import_module("5dai.services.tasks")
+store = importlib.import_module("5dai.support.store")
+
+
+def bench_single(questions: list[str]) -> float:
+    """Return the number of tasks created per second, one call per task."""
+    start = time.perf_counter()
+    for question in questions:
+        services.create_task(models.CreateTaskRequest(question, []))
+    return len(questions) / (time.perf_counter() - start)
+
+
+def bench_batch(questions: list[str], batch_size: int) -> float:
+    """Return the number of tasks created per second, in batches."""
+    start = time.perf_counter()
+    for i in range(0, len(questions), batch_size):
+        services.create_tasks(
+            models.CreateTasksRequest(questions[i : i + batch_size], [])
+        )
+    return len(questions) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tasks", type=int, default=1000)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument(
+        "--batch-sizes", type=int, nargs="+", default=[10, 100, 1000]
+    )
+    args = parser.parse_args()
+
+    questions = [f"Question {i}?" for i in range(args.tasks)]
+    print(f"{'batch':>6} {'tasks/s':>10}")
+    for batch_size in (1, *args.batch_sizes):
+        with tempfile.TemporaryDirectory() as data_dir:
+            os.environ["APP_DATA_DIR"] = data_dir
+            os.environ["APP_SQLITE_SHARDS"] = str(args.shards)
+            store.init_database()
+            rate = (
+                bench_single(questions)
+                if batch_size == 1
+                else bench_batch(questions, batch_size)
+            )
+        print(f"{batch_size:>6} {rate:>10.1f}")
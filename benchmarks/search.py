@@ -0,0 +1,117 @@
+"""Benchmark full-text search latency over a large synthetic corpus.
+
+Conversation turns are written straight into the shard databases, letting
+the triggers keep the full-text index up to date, and then queried through
+the search service with terms of varying frequency.
+
+Usage: `python benchmarks/search.py [--turns 1000000] [--shards 1]`
+"""
+
+import argparse
+import importlib
+import itertools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "source"))
+
+search = importlib.import_module("5dai.services.search")
+store = importlib.import_module("5dai.support.store")
+
+TURNS_PER_TASK = 10
+WORDS_PER_TURN = 30
+
+
+def _sentence(vocabulary: list[str], cum_weights: list[float]) -> str:
+    return " ".join(
+        random.choices(vocabulary, cum_weights=cum_weights, k=WORDS_PER_TURN)
+    )
+
+
+def build_corpus(turns: int, vocabulary: list[str]) -> None:
+    """Write `turns` conversation turns spread over the shards."""
+    # Zipf-like word frequencies, as in natural text
+    weights = list(
+        itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary)))
+    )
+    for start in range(0, turns // TURNS_PER_TASK, 1000):
+        ids = [
+            store.allocate_task_id()
+            for _ in range(min(1000, turns // TURNS_PER_TASK - start))
+        ]
+        for id_ in ids:
+            with store.connect_task(id_) as connection:
+                connection.execute(
+                    "INSERT INTO tasks (id, status) VALUES (?, 'completed')",
+                    (id_,),
+                )
+                connection.executemany(
+                    "INSERT INTO task_conversations (task_id, question, answer) VALUES (?, ?, ?)",
+                    (
+                        (
+                            id_,
+                            _sentence(vocabulary, weights),
+                            _sentence(vocabulary, weights),
+                        )
+                        for _ in range(TURNS_PER_TASK)
+                    ),
+                )
+
+
+def bench(terms: list[str], pages: int) -> list[float]:
+    """Return the latencies in milliseconds of searching each term."""
+    latencies = []
+    for term in terms:
+        for page in range(pages):
+            start = time.perf_counter()
+            search.search(term, offset=page * 20, limit=20)
+            latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=1_000_000)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--vocabulary", type=int, default=20_000)
+    parser.add_argument("--pages", type=int, default=3)
+    args = parser.parse_args()
+
+    random.seed(0)
+    vocabulary = [f"word{i}" for i in range(args.vocabulary)]
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.environ["APP_DATA_DIR"] = data_dir
+        os.environ["APP_SQLITE_SHARDS"] = str(args.shards)
+        store.init_database()
+
+        start = time.perf_counter()
+        build_corpus(args.turns, vocabulary)
+        print(
+            f"Indexed {args.turns} turns in {time.perf_counter() - start:.1f}s"
+        )
+
+        print(f"{'terms':>16} {'p50 ms':>8} {'p95 ms':>8}")
+        for label, terms in (
+            ("frequent", vocabulary[:10]),
+            ("medium", vocabulary[1000:1010]),
+            ("rare", vocabulary[-10:]),
+            (
+                "two-term",
+                [
+                    f"{a} {b}"
+                    for a, b in zip(
+                        vocabulary[:10], vocabulary[100:110], strict=True
+                    )
+                ],
+            ),
+        ):
+            latencies = sorted(bench(terms, args.pages))
+            p95 = latencies[int(len(latencies) * 0.95) - 1]
+            print(
+                f"{label:>16} {statistics.median(latencies):>8.2f} {p95:>8.2f}"
+            )
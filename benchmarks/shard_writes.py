@@ -0,0 +1,74 @@
+"""Benchmark task write throughput against the number of SQLite shards.
+
+Each worker process, standing in for a service worker, replays the writes
+of a task's lifecycle through the service layer: create the task with its
+first question, mark it started, store the answer and mark it completed.
+
+Usage: `python benchmarks/shard_writes.py [--workers 16] [--tasks 200]`
+"""
+
+import argparse
+import importlib
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "source"))
+
+models = importlib.import_module("5dai.models.tasks")
+common = importlib.import_module("5dai.models.common")
+services = importlib.import_module("5dai.services.tasks")
+store = importlib.import_module("5dai.support.store")
+
+
+def _run_lifecycle(count: int, barrier: multiprocessing.Barrier) -> None:
+    # Line up with the other workers so that start-up is not measured
+    barrier.wait()
+    for i in range(count):
+        id_ = services._add_task()
+        services._add_task_conversation(
+            id_, models.TaskUserInput(f"Question {i}?", [])
+        )
+        services._update_task_status(id_, common.TaskStatus.started)
+        services._update_task_answer(id_, f"Answer {i}.")
+        services._update_task_status(id_, common.TaskStatus.completed)
+
+
+def bench(shards: int, workers: int, tasks: int) -> float:
+    """Return the number of task lifecycles written per second."""
+    with tempfile.TemporaryDirectory() as data_dir:
+        os.environ["APP_DATA_DIR"] = data_dir
+        os.environ["APP_SQLITE_SHARDS"] = str(shards)
+        store.init_database()
+
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(workers + 1)
+        processes = [
+            context.Process(target=_run_lifecycle, args=(tasks, barrier))
+            for _ in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for process in processes:
+            process.join()
+        return workers * tasks / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--tasks", type=int, default=200)
+    parser.add_argument(
+        "--shards", type=int, nargs="+", default=[1, 2, 4, 8, 16]
+    )
+    args = parser.parse_args()
+
+    print(f"{'shards':>6} {'tasks/s':>10}")
+    for shards in args.shards:
+        rate = bench(shards, args.workers, args.tasks)
+        print(f"{shards:>6} {rate:>10.1f}")
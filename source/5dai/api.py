@@ -1,22 +1,46 @@
 """API layer for the module."""
 
+import asyncio
 import logging as log
 import os
+import secrets
 from typing import Annotated
 
 from dotenv import load_dotenv
 from fastapi import (
     BackgroundTasks,
+    Depends,
     FastAPI,
     File,
     Form,
+    Header,
     HTTPException,
+    Query,
+    Request,
     UploadFile,
 )
-from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import (
+    FileResponse,
+    PlainTextResponse,
+    StreamingResponse,
+)
 
 from .models import tasks as models
+from .models.collections import (
+    CollectionResponse,
+    CreateCollectionRequest,
+    UpdateCollectionRequest,
+)
+from .models.profiling import SlowCallsResponse
+from .models.search import SearchResponse
+from .models.transfer import ImportTasksResponse
+from .services import collections as collection_services
+from .services import search as search_services
 from .services import tasks as services
+from .services import transfer as transfer_services
+from .support import profiling
+from .support.llm import close_clients
 from .support.store import init_database
 
 load_dotenv()
@@ -27,6 +51,34 @@ log.getLogger().setLevel(os.getenv("APP_LOG_LEVEL", "INFO"))
 init_database()
 
 app = FastAPI()
+app.add_middleware(profiling.track_requests)
+
+
+def _check_admin(
+    x_admin_token: Annotated[str | None, Header()] = None
+) -> None:
+    """Allow admin requests only with the `APP_ADMIN_TOKEN` header."""
+    token = os.getenv("APP_ADMIN_TOKEN")
+    if not token:
+        raise HTTPException(404, "Not Found")
+    if x_admin_token is None or not secrets.compare_digest(
+        x_admin_token, token
+    ):
+        raise HTTPException(403, "Forbidden")
+
+
+@app.on_event("startup")
+async def startup() -> None:
+    """Make older uploads searchable, in the background."""
+    asyncio.get_running_loop().run_in_executor(
+        None, search_services.index_missing_files
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    """Release pooled LLM clients."""
+    await close_clients()
 
 
 @app.get("/health")
@@ -40,14 +92,93 @@ async def create_task(
     background_tasks: BackgroundTasks,
     question: Annotated[str, Form()],
     files: Annotated[list[UploadFile], File()] = [],
+    collections: Annotated[list[int], Form()] = [],
 ) -> models.TaskActionResponse:
-    """Create a task."""
-    log.debug("create_task(): question=%s, files=%s", question, files)
-    response = services.create_task(models.CreateTaskRequest(question, files))
+    """Create a task, optionally asking against collections."""
+    log.debug(
+        "create_task(): question=%s, files=%s, collections=%s",
+        question,
+        files,
+        collections,
+    )
+    try:
+        # Files are indexed with blocking embedding calls
+        response = await run_in_threadpool(
+            services.create_task,
+            models.CreateTaskRequest(question, files, collections),
+        )
+    except ValueError as e:
+        raise HTTPException(400, str(e)) from e
     background_tasks.add_task(services.run_task, response.id_)
     return response
 
 
+@app.post("/tasks:batch")
+async def create_tasks(
+    background_tasks: BackgroundTasks,
+    questions: Annotated[list[str], Form()],
+    files: Annotated[list[UploadFile], File()] = [],
+    collections: Annotated[list[int], Form()] = [],
+) -> models.CreateTasksResponse:
+    """Create a task per question, all sharing the same files and collections."""
+    log.debug("create_tasks(): questions=%d, files=%s", len(questions), files)
+    try:
+        response = await run_in_threadpool(
+            services.create_tasks,
+            models.CreateTasksRequest(questions, files, collections),
+        )
+    except ValueError as e:
+        raise HTTPException(400, str(e)) from e
+    background_tasks.add_task(
+        services.run_tasks, [task.id_ for task in response.tasks]
+    )
+    return response
+
+
+@app.get("/tasks:export")
+async def export_tasks(
+    ids: Annotated[list[int] | None, Query()] = None,
+    include_index: bool = True,
+) -> StreamingResponse:
+    """Export tasks, all of them by default, as NDJSON."""
+    return StreamingResponse(
+        transfer_services.export_tasks(ids, include_index),
+        media_type="application/x-ndjson",
+    )
+
+
+@app.post("/tasks:import")
+async def import_tasks(
+    request: Request, reuse_index: bool = False
+) -> ImportTasksResponse:
+    """Import tasks from NDJSON as exported, under new IDs."""
+    import_ = transfer_services.TaskImport(reuse_index)
+    try:
+        batch = []
+        async for record in transfer_services.aiter_records(request.stream()):
+            batch.append(record)
+            if len(batch) >= 64:
+                await run_in_threadpool(
+                    transfer_services.add_records, import_, batch
+                )
+                batch = []
+        await run_in_threadpool(transfer_services.add_records, import_, batch)
+        await run_in_threadpool(transfer_services.close_import, import_)
+    except Exception as e:
+        await run_in_threadpool(transfer_services.abort_import, import_)
+        log.exception("Error importing tasks: %s", e)
+        # Tasks are imported one by one, so those before the error are kept
+        raise HTTPException(
+            400, {"message": "Error importing tasks", "ids": import_.ids}
+        ) from e
+    return ImportTasksResponse(
+        tasks=import_.tasks,
+        files=import_.files,
+        ids=import_.ids,
+        unlinked_collections=import_.unlinked_collections,
+    )
+
+
 @app.post("/tasks/{id_}")
 async def update_task(
     background_tasks: BackgroundTasks,
@@ -57,8 +188,10 @@ async def update_task(
 ) -> models.TaskActionResponse:
     """Update a task."""
     try:
-        response = services.update_task(
-            id_, models.UpdateTaskRequest(question, files)
+        response = await run_in_threadpool(
+            services.update_task,
+            id_,
+            models.UpdateTaskRequest(question, files),
         )
         background_tasks.add_task(services.run_task, response.id_)
         return response
@@ -82,6 +215,93 @@ async def read_task(id_: int) -> models.ReadTaskResponse:
     return response
 
 
+@app.post("/collections")
+async def create_collection(
+    background_tasks: BackgroundTasks,
+    name: Annotated[str, Form()],
+    files: Annotated[list[UploadFile], File()],
+) -> CollectionResponse:
+    """Create a collection of documents, indexed once for all tasks."""
+    log.debug("create_collection(): name=%s, files=%s", name, files)
+    response = collection_services.create_collection(
+        CreateCollectionRequest(name, files)
+    )
+    background_tasks.add_task(
+        collection_services.index_collection, response.id_
+    )
+    return response
+
+
+@app.post("/collections/{id_}")
+async def update_collection(
+    background_tasks: BackgroundTasks,
+    id_: int,
+    files: Annotated[list[UploadFile], File()],
+) -> CollectionResponse:
+    """Add documents to a collection."""
+    try:
+        response = collection_services.update_collection(
+            id_, UpdateCollectionRequest(files)
+        )
+    except ValueError as e:
+        raise HTTPException(404, "Collection not found") from e
+    background_tasks.add_task(collection_services.index_collection, id_)
+    return response
+
+
+@app.get("/collections/{id_}")
+async def read_collection(id_: int) -> CollectionResponse:
+    """Read a collection."""
+    response = collection_services.get_collection(id_)
+    if response is None:
+        raise HTTPException(404, "Collection not found")
+    return response
+
+
+@app.get("/search")
+async def search(
+    q: Annotated[str, Query(min_length=1)],
+    offset: Annotated[int, Query(ge=0)] = 0,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+) -> SearchResponse:
+    """Search conversations and files of all tasks."""
+    # Queries over all shards can take a while, so keep the loop free
+    return await run_in_threadpool(search_services.search, q, offset, limit)
+
+
+@app.get(
+    "/admin/profile",
+    dependencies=[Depends(_check_admin)],
+    response_class=PlainTextResponse,
+)
+async def profile(
+    seconds: Annotated[float, Query(gt=0, le=60)] = 5,
+    interval_ms: Annotated[float | None, Query(ge=1, le=1000)] = None,
+) -> PlainTextResponse:
+    """Sample all threads and tasks, returning collapsed stacks."""
+    interval = (
+        interval_ms / 1000
+        if interval_ms is not None
+        else profiling.get_interval()
+    )
+    try:
+        collapsed = await run_in_threadpool(
+            profiling.profile, seconds, interval, asyncio.get_running_loop()
+        )
+    except RuntimeError as e:
+        raise HTTPException(409, str(e)) from e
+    return PlainTextResponse(collapsed)
+
+
+@app.get("/admin/slow", dependencies=[Depends(_check_admin)])
+async def read_slow_calls() -> SlowCallsResponse:
+    """Read the profiles of the latest requests and tasks that were slow."""
+    return SlowCallsResponse(
+        threshold=profiling.get_slow_threshold(),
+        calls=profiling.get_slow_calls(),
+    )
+
+
 @app.get("/tasks/{task_id}/files/{file_id}")
 async def download_file() -> FileResponse:
     return FileResponse()
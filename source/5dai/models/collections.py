@@ -0,0 +1,38 @@
+"""Collection models."""
+
+from dataclasses import dataclass
+from datetime import datetime
+
+from fastapi import UploadFile
+
+from .common import FileInfo, IdentityAware
+
+
+class CollectionFile(IdentityAware, FileInfo):
+    """Collection file."""
+
+    indexed: bool
+
+
+@dataclass
+class CreateCollectionRequest:
+    """Create collection request."""
+
+    name: str
+    files: list[UploadFile]
+
+
+@dataclass
+class UpdateCollectionRequest:
+    """Update collection request, i.e. more files to add."""
+
+    files: list[UploadFile]
+
+
+class CollectionResponse(IdentityAware):
+    """Collection response."""
+
+    name: str
+    created_at: datetime
+    updated_at: datetime
+    files: list[CollectionFile] = []
@@ -0,0 +1,22 @@
+"""Profiling models."""
+
+from datetime import datetime
+
+from pydantic import BaseModel
+
+
+class SlowCall(BaseModel):
+    """Slow call, i.e. a request or task that ran past the threshold."""
+
+    name: str
+    started_at: datetime
+    duration: float
+    samples: int
+    profile: str
+
+
+class SlowCallsResponse(BaseModel):
+    """Slow calls response, most recent first."""
+
+    threshold: float
+    calls: list[SlowCall] = []
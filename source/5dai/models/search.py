@@ -0,0 +1,35 @@
+"""Search models."""
+
+from enum import Enum
+
+from pydantic import BaseModel
+
+from .common import IdentityAware
+
+
+class SearchHitKind(str, Enum):
+    """Search hit kind enumeration."""
+
+    conversation = "conversation"
+    file = "file"
+
+
+class SearchHit(IdentityAware):
+    """Search hit, i.e. a conversation or file of a task matching a query.
+
+    `snippet` is HTML: the matched text is escaped, with matches in `<b>`.
+    """
+
+    task_id: int
+    kind: SearchHitKind
+    snippet: str
+    rank: float
+
+
+class SearchResponse(BaseModel):
+    """Search response."""
+
+    query: str
+    offset: int
+    limit: int
+    hits: list[SearchHit] = []
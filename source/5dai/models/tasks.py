@@ -1,9 +1,10 @@
 """Task models."""
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
 
 from fastapi import UploadFile
+from pydantic import BaseModel
 
 from .common import (
     ConversationInfo,
@@ -33,10 +34,20 @@ class TaskUserInput:
     files: list[UploadFile]
 
 
+@dataclass
 class CreateTaskRequest(TaskUserInput):
-    """Create task request."""
+    """Create task request, optionally asking against collections."""
 
-    pass
+    collections: list[int] = field(default_factory=list)
+
+
+@dataclass
+class CreateTasksRequest:
+    """Create tasks request, i.e. many questions sharing the same files."""
+
+    questions: list[str]
+    files: list[UploadFile]
+    collections: list[int] = field(default_factory=list)
 
 
 class UpdateTaskRequest(TaskUserInput):
@@ -58,3 +69,10 @@ class ReadTaskResponse(TaskActionResponse):
 
     conversations: list[TaskConversation] = []
     files: list[TaskFile] = []
+    collections: list[int] = []
+
+
+class CreateTasksResponse(BaseModel):
+    """Create tasks response."""
+
+    tasks: list[TaskActionResponse]
@@ -0,0 +1,13 @@
+"""Transfer models."""
+
+from pydantic import BaseModel
+
+
+class ImportTasksResponse(BaseModel):
+    """Import tasks response."""
+
+    tasks: int
+    files: int
+    ids: list[int] = []
+    # Exported collection IDs of imported tasks, whose links were dropped
+    unlinked_collections: dict[int, list[int]] = {}
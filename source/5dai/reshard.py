@@ -0,0 +1,247 @@
+"""Move tasks between SQLite shards while the service is running.
+
+Usage: `python -m 5dai.reshard <shard count>`
+
+Each task is moved while holding the write lock of the source shard, and
+the catalog points at the new shard before the lock is released. Writers
+of the service take the same lock and then check that the task is still
+there, following it to the new shard otherwise, so no write is lost. Tasks
+that are currently running are skipped and reported, and tasks whose IDs
+are allocated but not created yet are left alone, so the tool can simply be
+run again later. Start the service with `APP_SQLITE_SHARDS` set to the new
+count so that new tasks are spread in the same way.
+
+Conversation and file IDs are only unique per shard, so moved tasks get new
+ones. These IDs, as returned by `GET /tasks/{id}` and `GET /search`, are
+therefore not stable across resharding; task IDs are. Uploaded files and
+their indexes are named by file ID, so they are linked under the new names
+before the task is committed to the new shard, and the old names are only
+removed once it is deleted from the old one. A move interrupted before the
+catalog points at the new shard keeps the old names, and the next run
+clears the new ones. Only a crash after that but before the old rows are
+deleted leaves them and the old names behind, to be removed by hand.
+"""
+
+import argparse
+import logging as log
+import os
+import shutil
+
+from dotenv import load_dotenv
+
+from .models.common import TaskStatus
+from .support.paths import (
+    get_index_dir_path,
+    get_upload_dir_path,
+    get_upload_file_path,
+)
+from .support.store import (
+    connect_catalog,
+    connect_shard,
+    init_database,
+    init_shard,
+)
+
+
+def _link(source: str, target: str) -> None:
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def _get_file_paths(id_: int, file_id: int, name: str) -> tuple[str, str]:
+    """Get the paths to an uploaded file and to its own index, if any."""
+    return (
+        get_upload_file_path(id_, f"{file_id}-{name}"),
+        os.path.join(get_index_dir_path(id_), str(file_id)),
+    )
+
+
+def _remove_file(upload_path: str, index_path: str) -> None:
+    if os.path.exists(upload_path):
+        os.remove(upload_path)
+    shutil.rmtree(index_path, ignore_errors=True)
+
+
+def _remove_stale_files(id_: int, file_ids: set[int]) -> None:
+    """Remove files of a task left by an earlier move that did not complete.
+
+    Only the files in `file_ids` are current, as read under the write lock.
+    """
+    for name in os.listdir(get_upload_dir_path(id_)):
+        file_id, _, _ = name.partition("-")
+        if file_id.isdigit() and int(file_id) not in file_ids:
+            os.remove(get_upload_file_path(id_, name))
+    index_dir = get_index_dir_path(id_)
+    for name in os.listdir(index_dir):
+        if name.isdigit() and int(name) not in file_ids:
+            shutil.rmtree(os.path.join(index_dir, name), ignore_errors=True)
+
+
+def _link_files(id_: int, renames: list[tuple[int, int, str]]) -> None:
+    """Give uploaded files and their indexes their new IDs, keeping the old.
+
+    New IDs never clash with old ones, so both names can exist until the
+    move is complete.
+    """
+    for old_id, new_id, name in renames:
+        old_upload, old_index = _get_file_paths(id_, old_id, name)
+        new_upload, new_index = _get_file_paths(id_, new_id, name)
+        _remove_file(new_upload, new_index)
+        if os.path.exists(old_upload):
+            _link(old_upload, new_upload)
+        if os.path.isdir(old_index):
+            shutil.copytree(old_index, new_index, copy_function=_link)
+
+
+def _move_task(id_: int, source_shard: int, target_shard: int) -> bool | None:
+    """Move a task with its conversations and files to another shard.
+
+    Returns False if the task is running, or None if it does not exist yet.
+    """
+    source = connect_shard(source_shard)
+    target = connect_shard(target_shard)
+    catalog = connect_catalog()
+    try:
+        # Hold the source write lock so that the task cannot change meanwhile
+        source.execute("BEGIN IMMEDIATE")
+        task = source.execute(
+            "SELECT id, status, summary, created_at, updated_at FROM tasks WHERE id = ?",
+            (id_,),
+        ).fetchone()
+        if task is None:
+            # Not created yet, so only the catalog knows where it will be
+            source.rollback()
+            return None
+        if task[1] == TaskStatus.started:
+            source.rollback()
+            return False
+
+        files = source.execute(
+            "SELECT id, task_id, name, size, content_type, uploaded_at FROM task_files WHERE task_id = ? ORDER BY id ASC",
+            (id_,),
+        ).fetchall()
+        _remove_stale_files(id_, {file[0] for file in files})
+
+        # Clear leftovers of an earlier move that did not complete
+        target.execute(
+            "DELETE FROM task_conversations WHERE task_id = ?", (id_,)
+        )
+        target.execute("DELETE FROM task_files WHERE task_id = ?", (id_,))
+        target.execute(
+            "DELETE FROM task_collections WHERE task_id = ?", (id_,)
+        )
+        target.execute("DELETE FROM tasks WHERE id = ?", (id_,))
+        target.execute(
+            "INSERT INTO tasks (id, status, summary, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            task,
+        )
+        # Child IDs are only unique per shard, so they are reassigned
+        target.executemany(
+            "INSERT INTO task_conversations (task_id, question, answer, generated_at) VALUES (?, ?, ?, ?)",
+            source.execute(
+                "SELECT task_id, question, answer, generated_at FROM task_conversations WHERE task_id = ? ORDER BY id ASC",
+                (id_,),
+            ).fetchall(),
+        )
+        target.executemany(
+            "INSERT INTO task_collections (task_id, collection_id) VALUES (?, ?)",
+            source.execute(
+                "SELECT task_id, collection_id FROM task_collections WHERE task_id = ?",
+                (id_,),
+            ).fetchall(),
+        )
+        # New file IDs follow the old ones, so that files can have both
+        # names until the move is complete
+        new_id = max(
+            target.execute("SELECT MAX(id) FROM task_files").fetchone()[0]
+            or 0,
+            files[-1][0] if files else 0,
+        )
+        renames = []
+        for file_id, *file in files:
+            new_id += 1
+            target.execute(
+                "INSERT INTO task_files (id, task_id, name, size, content_type, uploaded_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (new_id, *file),
+            )
+            target.executemany(
+                "INSERT INTO task_files_fts (rowid, name, content) VALUES (?, ?, ?)",
+                (
+                    (new_id, *text)
+                    for text in source.execute(
+                        "SELECT name, content FROM task_files_fts WHERE rowid = ?",
+                        (file_id,),
+                    )
+                ),
+            )
+            renames.append((file_id, new_id, file[1]))
+        _link_files(id_, renames)
+        target.commit()
+
+        catalog.execute(
+            "UPDATE task_shards SET shard = ? WHERE id = ?",
+            (target_shard, id_),
+        )
+        catalog.commit()
+
+        source.execute(
+            "DELETE FROM task_conversations WHERE task_id = ?", (id_,)
+        )
+        source.execute("DELETE FROM task_files WHERE task_id = ?", (id_,))
+        source.execute(
+            "DELETE FROM task_collections WHERE task_id = ?", (id_,)
+        )
+        source.execute("DELETE FROM tasks WHERE id = ?", (id_,))
+        source.commit()
+
+        for old_id, _, name in renames:
+            _remove_file(*_get_file_paths(id_, old_id, name))
+        return True
+    except Exception:
+        target.rollback()
+        source.rollback()
+        raise
+
+
+def reshard(count: int) -> list[int]:
+    """Move tasks so that each task lives in shard `id % count`.
+
+    Returns the IDs of tasks that were skipped because they were running.
+    """
+    init_database()
+    for shard in range(count):
+        init_shard(shard)
+
+    rows = (
+        connect_catalog()
+        .execute(
+            "SELECT id, shard FROM task_shards WHERE shard >= 0 AND shard != id % ?",
+            (count,),
+        )
+        .fetchall()
+    )
+
+    skipped = []
+    for id_, shard in rows:
+        moved = _move_task(id_, shard, id_ % count)
+        if moved is None:
+            log.debug("Left task %d, not created yet", id_)
+        elif moved:
+            log.info("Moved task %d from shard %d", id_, shard)
+        else:
+            log.warning("Skipped running task %d", id_)
+            skipped.append(id_)
+    return skipped
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    log.basicConfig(level=os.getenv("APP_LOG_LEVEL", "INFO"))
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("count", type=int, help="new number of shards")
+    skipped = reshard(parser.parse_args().count)
+    if skipped:
+        print(f"Skipped running tasks, rerun to move them: {skipped}")
@@ -0,0 +1,174 @@
+"""Collection service, i.e. documents uploaded and indexed once for many tasks."""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import closing
+from datetime import datetime
+
+from fastapi import UploadFile
+
+from ..models.collections import (
+    CollectionFile,
+    CollectionResponse,
+    CreateCollectionRequest,
+    UpdateCollectionRequest,
+)
+from ..support.llm import reindex_collection
+from ..support.paths import (
+    get_collection_index_dir_path,
+    get_collection_upload_dir_path,
+    get_collection_upload_file_path,
+)
+from ..support.store import connect_catalog
+
+log = logging.getLogger("services.collections")
+
+_index_locks: dict[int, threading.Lock] = {}
+_index_locks_lock = threading.Lock()
+
+
+def _is_file_indexed(id_: int, file_id: int) -> bool:
+    return os.path.exists(
+        os.path.join(
+            get_collection_index_dir_path(id_), str(file_id), "docstore.json"
+        )
+    )
+
+
+def _query_collection(id_: int) -> CollectionResponse | None:
+    log.debug("_query_collection(): Getting collection with id=%d", id_)
+    with closing(connect_catalog().cursor()) as cursor:
+        row = cursor.execute(
+            "SELECT id, name, created_at, updated_at FROM collections WHERE id = ?",
+            (id_,),
+        ).fetchone()
+        if row is None:
+            return None
+        file_rows = cursor.execute(
+            "SELECT id, name, size, content_type, uploaded_at FROM collection_files WHERE collection_id = ? ORDER BY id ASC",
+            (id_,),
+        ).fetchall()
+
+    return CollectionResponse(
+        id=row[0],
+        name=row[1],
+        created_at=row[2],
+        updated_at=row[3],
+        files=[
+            CollectionFile(
+                id=f[0],
+                name=f[1],
+                size=f[2],
+                content_type=f[3],
+                uploaded_at=f[4],
+                indexed=_is_file_indexed(id_, f[0]),
+            )
+            for f in file_rows
+        ],
+    )
+
+
+def _save_upload(id_: int, file: UploadFile) -> str:
+    """Save an uploaded file under a temporary name, ignored by indexing."""
+    fd, path = tempfile.mkstemp(
+        prefix=".upload-", dir=get_collection_upload_dir_path(id_)
+    )
+    with closing(os.fdopen(fd, "wb")) as out_, closing(file.file) as in_:
+        shutil.copyfileobj(in_, out_)
+    return path
+
+
+def _add_collection_files(id_: int, files: list[UploadFile]) -> None:
+    # Files are saved before the catalog transaction, which also allocates
+    # task IDs, so that it is not held open meanwhile
+    paths = []
+    try:
+        for file in files:
+            paths.append(_save_upload(id_, file))
+            log.debug("_add_collection_files(): Saved file %s", file.filename)
+
+        with connect_catalog() as connection, closing(
+            connection.cursor()
+        ) as cursor:
+            file_ids = []
+            for file in files:
+                cursor.execute(
+                    "INSERT INTO collection_files (collection_id, name, size, content_type) VALUES (?, ?, ?, ?)",
+                    (id_, file.filename, file.size, file.content_type),
+                )
+                file_ids.append(cursor.lastrowid)
+                log.debug(
+                    "_add_collection_files(): Added file with id=%d",
+                    cursor.lastrowid,
+                )
+            cursor.execute(
+                "UPDATE collections SET updated_at = ? WHERE id = ?",
+                (datetime.now(), id_),
+            )
+    except Exception:
+        for path in paths:
+            os.remove(path)
+        raise
+
+    for file, file_id, path in zip(files, file_ids, paths, strict=True):
+        os.replace(
+            path,
+            get_collection_upload_file_path(id_, f"{file_id}-{file.filename}"),
+        )
+
+
+def check_collections(ids: list[int]) -> None:
+    """Raise a `ValueError` unless all the collections exist."""
+    with closing(connect_catalog().cursor()) as cursor:
+        found = {
+            id_
+            for id_ in set(ids)
+            if cursor.execute(
+                "SELECT 1 FROM collections WHERE id = ?", (id_,)
+            ).fetchone()
+        }
+    missing = sorted(set(ids) - found)
+    if len(missing) > 0:
+        raise ValueError(f"Collections not found: {missing}")
+
+
+def get_collection(id_: int) -> CollectionResponse | None:
+    """Get a collection with its files."""
+    return _query_collection(id_)
+
+
+def create_collection(data: CreateCollectionRequest) -> CollectionResponse:
+    """Create a collection, leaving its files to `index_collection()`."""
+    with connect_catalog() as connection, closing(
+        connection.cursor()
+    ) as cursor:
+        cursor.execute(
+            "INSERT INTO collections (name, created_at, updated_at) VALUES (?, ?, ?)",
+            (data.name, datetime.now(), datetime.now()),
+        )
+        id_ = cursor.lastrowid
+    log.debug("create_collection(): Added collection with id=%d", id_)
+    _add_collection_files(id_, data.files)
+    return _query_collection(id_)
+
+
+def update_collection(
+    id_: int, data: UpdateCollectionRequest
+) -> CollectionResponse:
+    """Add files to a collection, leaving them to `index_collection()`."""
+    check_collections([id_])
+    _add_collection_files(id_, data.files)
+    return _query_collection(id_)
+
+
+def index_collection(id_: int) -> None:
+    """Index the files of a collection not indexed yet."""
+    with _index_locks_lock:
+        lock = _index_locks.setdefault(id_, threading.Lock())
+    # Indexing the same file twice at once would garble its index
+    with lock:
+        reindex_collection(id_)
+    log.debug("index_collection(): Indexed collection with id=%d", id_)
@@ -0,0 +1,156 @@
+"""Search service."""
+
+import heapq
+import html
+import logging
+from contextlib import closing
+from itertools import islice
+
+from ..models.search import SearchHit, SearchResponse
+from ..support.llm import extract_text
+from ..support.paths import get_upload_file_path
+from ..support.store import connect_shard, get_shard_count, write_task
+
+log = logging.getLogger("services.search")
+
+SQL_SEARCH = """
+SELECT 'conversation', rowid, rank FROM task_conversations_fts
+WHERE task_conversations_fts MATCH :query
+UNION ALL
+SELECT 'file', rowid, rank FROM task_files_fts
+WHERE task_files_fts MATCH :query
+ORDER BY rank
+LIMIT :limit
+"""
+
+SQL_MISSING_FILES = """
+SELECT f.id, f.task_id, f.name FROM task_files f
+WHERE NOT EXISTS (SELECT 1 FROM task_files_fts t WHERE t.rowid = f.id)
+ORDER BY f.id ASC
+"""
+
+# Snippets are costly, so they are only made for the hits being returned.
+# Matches are marked with control characters, replaced once the text around
+# them is HTML-escaped.
+SQL_SNIPPETS = {
+    "conversation": """
+SELECT c.task_id, snippet(task_conversations_fts, -1, char(2), char(3), '...', 16)
+FROM task_conversations_fts
+JOIN task_conversations c ON c.id = task_conversations_fts.rowid
+WHERE task_conversations_fts MATCH :query AND task_conversations_fts.rowid = :id
+""",
+    "file": """
+SELECT f.task_id, snippet(task_files_fts, -1, char(2), char(3), '...', 16)
+FROM task_files_fts
+JOIN task_files f ON f.id = task_files_fts.rowid
+WHERE task_files_fts MATCH :query AND task_files_fts.rowid = :id
+""",
+}
+
+
+def _to_match_query(q: str) -> str:
+    """Quote each term so that user input is never parsed as FTS5 syntax."""
+    return " ".join('"' + term.replace('"', '""') + '"' for term in q.split())
+
+
+def _to_html(snippet: str) -> str:
+    return html.escape(snippet).replace("\x02", "<b>").replace("\x03", "</b>")
+
+
+def _search_shard(shard: int, query: str, limit: int) -> list[tuple]:
+    with closing(connect_shard(shard).cursor()) as cursor:
+        return [
+            (shard, *row)
+            for row in cursor.execute(
+                SQL_SEARCH, {"query": query, "limit": limit}
+            )
+        ]
+
+
+def _to_hit(
+    shard: int, kind: str, id_: int, rank: float, query: str
+) -> SearchHit | None:
+    with closing(connect_shard(shard).cursor()) as cursor:
+        row = cursor.execute(
+            SQL_SNIPPETS[kind], {"query": query, "id": id_}
+        ).fetchone()
+    # The row may have been moved or deleted since it was ranked
+    return (
+        SearchHit(
+            task_id=row[0],
+            kind=kind,
+            id=id_,
+            snippet=_to_html(row[1]),
+            rank=rank,
+        )
+        if row
+        else None
+    )
+
+
+def search(q: str, offset: int = 0, limit: int = 20) -> SearchResponse:
+    """Search conversations and file text of all tasks, best matches first.
+
+    Ranks come from each shard's own statistics, so ordering across shards
+    is approximate.
+    """
+    query = _to_match_query(q)
+    log.debug("search(): query=%s, offset=%d, limit=%d", query, offset, limit)
+    response = SearchResponse(query=q, offset=offset, limit=limit)
+    if not query:
+        return response
+
+    # Every shard must supply enough rows to fill the requested page
+    rows = heapq.merge(
+        *(
+            _search_shard(shard, query, offset + limit)
+            for shard in range(get_shard_count())
+        ),
+        key=lambda row: row[3],
+    )
+    hits = (
+        _to_hit(*row, query) for row in islice(rows, offset, offset + limit)
+    )
+    response.hits = [hit for hit in hits if hit is not None]
+    return response
+
+
+def _index_file_text(id_: int, task_id: int, name: str) -> None:
+    path = get_upload_file_path(task_id, f"{id_}-{name}")
+    try:
+        text = extract_text(path)
+    except Exception as e:
+        # Stored empty, so that unreadable files are not read on every start
+        log.exception("Error extracting text of %s: %s", path, e)
+        text = ""
+    with write_task(task_id) as connection:
+        # File IDs change when a task is moved, so it must still be the same
+        if connection.execute(
+            "SELECT 1 FROM task_files WHERE id = ? AND task_id = ? AND name = ?",
+            (id_, task_id, name),
+        ).fetchone():
+            connection.execute(
+                "INSERT OR REPLACE INTO task_files_fts (rowid, name, content) VALUES (?, ?, ?)",
+                (id_, name, text),
+            )
+        connection.commit()
+
+
+def index_missing_files() -> None:
+    """Make files uploaded before search was added searchable.
+
+    Files are indexed for search when they are uploaded, so this only finds
+    older ones, and is cheap once they are all indexed.
+    """
+    for shard in range(get_shard_count()):
+        with closing(connect_shard(shard).cursor()) as cursor:
+            files = cursor.execute(SQL_MISSING_FILES).fetchall()
+        if files:
+            log.info("Indexing %d files of shard %d", len(files), shard)
+        for file in files:
+            try:
+                _index_file_text(*file)
+            except Exception as e:
+                log.exception(
+                    "Error indexing file %d for search: %s", file[0], e
+                )
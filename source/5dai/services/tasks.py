@@ -1,13 +1,17 @@
 """Task service."""
 
+import asyncio
 import logging
-import sqlite3
+import os
+import shutil
 from contextlib import closing
 from datetime import datetime
 
 from ..models.common import TaskStatus
 from ..models.tasks import (
     CreateTaskRequest,
+    CreateTasksRequest,
+    CreateTasksResponse,
     ReadTaskResponse,
     TaskActionResponse,
     TaskConversation,
@@ -15,12 +19,18 @@ from ..models.tasks import (
     TaskUserInput,
     UpdateTaskRequest,
 )
-from ..support.llm import reindex, run_ask, run_chat
-from ..support.paths import (
-    get_sqlite_file_path,
-    get_upload_dir_path,
-    get_upload_file_path,
+from ..support.llm import arun_ask, arun_chat, reindex
+from ..support.paths import get_index_dir_path, get_upload_file_path
+from ..support.profiling import track
+from ..support.store import (
+    allocate_task_id,
+    allocate_task_ids,
+    connect_shard,
+    connect_task,
+    get_task_shard,
+    write_task,
 )
+from .collections import check_collections
 
 log = logging.getLogger("services.tasks")
 
@@ -29,13 +39,9 @@ def _query_task(
     id_: int, extras: bool = False
 ) -> TaskActionResponse | ReadTaskResponse | None:
     log.debug("_query_task(): Getting task with id=%d", id_)
-    with closing(
-        sqlite3.connect(
-            get_sqlite_file_path(),
-            detect_types=sqlite3.PARSE_DECLTYPES,
-            check_same_thread=False,
-        )
-    ) as connection, closing(connection.cursor()) as cursor:
+    with connect_task(id_) as connection, closing(
+        connection.cursor()
+    ) as cursor:
         row = cursor.execute(
             "SELECT id, status, created_at, updated_at FROM tasks WHERE id = ?",
             (id_,),
@@ -57,6 +63,11 @@ def _query_task(
             ).fetchall()
             log.debug("_query_task(): Got files: %s", file_rows)
 
+            collection_rows = cursor.execute(
+                "SELECT collection_id FROM task_collections WHERE task_id = ? ORDER BY collection_id ASC",
+                (id_,),
+            ).fetchall()
+
             return (
                 ReadTaskResponse(
                     id=row[0],
@@ -82,6 +93,7 @@ def _query_task(
                         )
                         for f in file_rows
                     ],
+                    collections=[c[0] for c in collection_rows],
                 )
                 if row
                 else None
@@ -101,22 +113,20 @@ def _query_task(
 
 def _add_task() -> int:
     log.debug("_add_task(): Adding task")
-    with closing(
-        sqlite3.connect(
-            get_sqlite_file_path(),
-            detect_types=sqlite3.PARSE_DECLTYPES,
-            check_same_thread=False,
-        )
-    ) as connection, closing(connection.cursor()) as cursor:
+    id_ = allocate_task_id()
+    # A new task, routed as cached when its ID was allocated
+    with connect_shard(get_task_shard(id_)) as connection, closing(
+        connection.cursor()
+    ) as cursor:
         cursor.execute(
-            "INSERT INTO tasks (status, created_at, updated_at) VALUES (?, ?, ?)",
+            "INSERT INTO tasks (id, status, created_at, updated_at) VALUES (?, ?, ?, ?)",
             (
+                id_,
                 TaskStatus.created,
                 datetime.now(),
                 datetime.now(),
             ),
         )
-        id_ = cursor.lastrowid
         log.debug("_add_task(): Added task with id=%d", id_)
         connection.commit()
         return id_
@@ -127,13 +137,9 @@ def _add_task_conversation(task_id: int, data: TaskUserInput) -> None:
         "_add_task_conversation(): Adding conversation for task with id=%d",
         task_id,
     )
-    with closing(
-        sqlite3.connect(
-            get_sqlite_file_path(),
-            detect_types=sqlite3.PARSE_DECLTYPES,
-            check_same_thread=False,
-        )
-    ) as connection, closing(connection.cursor()) as cursor:
+    with write_task(task_id) as connection, closing(
+        connection.cursor()
+    ) as cursor:
         cursor.execute(
             "INSERT INTO task_conversations (task_id, question, generated_at) VALUES (?, ?, ?)",
             (
@@ -149,17 +155,19 @@ def _add_task_conversation(task_id: int, data: TaskUserInput) -> None:
         connection.commit()
 
 
+def _add_task_collections(task_id: int, collection_ids: list[int]) -> None:
+    with write_task(task_id) as connection:
+        connection.executemany(
+            "INSERT OR IGNORE INTO task_collections (task_id, collection_id) VALUES (?, ?)",
+            ((task_id, collection_id) for collection_id in collection_ids),
+        )
+
+
 def _update_task_answer(id_: int, answer: str) -> None:
     log.debug(
         "_update_task_answer(): Updating task's latest answer with id=%d", id_
     )
-    with closing(
-        sqlite3.connect(
-            get_sqlite_file_path(),
-            detect_types=sqlite3.PARSE_DECLTYPES,
-            check_same_thread=False,
-        )
-    ) as connection, closing(connection.cursor()) as cursor:
+    with write_task(id_) as connection, closing(connection.cursor()) as cursor:
         cursor.execute(
             "UPDATE task_conversations SET answer = ? WHERE id = (SELECT MAX(id) FROM task_conversations WHERE task_id = ?) AND answer IS NULL",
             (answer, id_),
@@ -173,13 +181,9 @@ def _update_task_answer(id_: int, answer: str) -> None:
 
 def _get_task_status(id_: int) -> TaskStatus | None:
     log.debug("_get_task_status(): Getting status for task with id=%d", id_)
-    with closing(
-        sqlite3.connect(
-            get_sqlite_file_path(),
-            detect_types=sqlite3.PARSE_DECLTYPES,
-            check_same_thread=False,
-        )
-    ) as connection, closing(connection.cursor()) as cursor:
+    with connect_task(id_) as connection, closing(
+        connection.cursor()
+    ) as cursor:
         row = cursor.execute(
             "SELECT status FROM tasks WHERE id = ?",
             (id_,),
@@ -190,12 +194,7 @@ def _get_task_status(id_: int) -> TaskStatus | None:
 
 def _update_task_status(id_: int, status: TaskStatus) -> None:
     log.debug("_update_task_status(): Updating task with id=%d", id_)
-    with closing(
-        sqlite3.connect(
-            get_sqlite_file_path(),
-            detect_types=sqlite3.PARSE_DECLTYPES,
-        )
-    ) as connection, closing(connection.cursor()) as cursor:
+    with write_task(id_) as connection, closing(connection.cursor()) as cursor:
         cursor.execute(
             "UPDATE tasks SET status = ?, updated_at = ? WHERE id = ?",
             (status, datetime.now(), id_),
@@ -204,14 +203,31 @@ def _update_task_status(id_: int, status: TaskStatus) -> None:
         connection.commit()
 
 
+def _add_task_files_text(
+    id_: int, files: list[tuple[int, str]], texts: dict[str, str]
+) -> None:
+    """Make files searchable with the text read when they were indexed."""
+    with write_task(id_) as connection:
+        # Replaced, as the text may have been backfilled meanwhile, and only
+        # if the file still has the same ID, which changes if the task was
+        # moved to another shard while indexing
+        connection.executemany(
+            "INSERT OR REPLACE INTO task_files_fts (rowid, name, content) SELECT id, name, ? FROM task_files WHERE id = ? AND task_id = ? AND name = ?",
+            (
+                (texts[f"{file_id}-{name}"], file_id, id_, name)
+                for file_id, name in files
+                if f"{file_id}-{name}" in texts
+            ),
+        )
+        connection.commit()
+
+
 def _add_task_files(id_: int, data: TaskUserInput) -> None:
     if len(data.files) > 0:
-        with closing(
-            sqlite3.connect(
-                get_sqlite_file_path(),
-                detect_types=sqlite3.PARSE_DECLTYPES,
-            )
-        ) as connection, closing(connection.cursor()) as cursor:
+        files = []
+        with write_task(id_) as connection, closing(
+            connection.cursor()
+        ) as cursor:
             for file in data.files:
                 name = file.filename
                 log.debug("_save_task_files(): Saving file %s", name)
@@ -222,16 +238,98 @@ def _add_task_files(id_: int, data: TaskUserInput) -> None:
                 file_id = cursor.lastrowid
                 log.debug("_save_task_files(): Added file with id=%d", file_id)
 
-                with closing(
-                    open(get_upload_file_path(id_, f"{file_id}-{name}"), "wb")
-                ) as out_, closing(file.file) as in_:
+                path = get_upload_file_path(id_, f"{file_id}-{name}")
+                with closing(open(path, "wb")) as out_, closing(
+                    file.file
+                ) as in_:
                     out_.write(in_.read())
                 log.debug("_save_task_files(): Saved file %s", name)
+                files.append((file_id, name))
 
             connection.commit()
 
-        reindex(id_)
+        texts = reindex(id_)
         log.debug("_save_task_files(): Reindexed task with id=%d", id_)
+        _add_task_files_text(id_, files, texts)
+
+
+def _get_task_file_names(id_: int) -> list[tuple[int, str]]:
+    with connect_task(id_) as connection, closing(
+        connection.cursor()
+    ) as cursor:
+        return cursor.execute(
+            "SELECT id, name FROM task_files WHERE task_id = ? ORDER BY id ASC",
+            (id_,),
+        ).fetchall()
+
+
+def _link_file(source: str, target: str) -> None:
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def _clone_task_files(
+    source_id: int, target_id: int, file_ids: dict[int, int]
+) -> None:
+    """Give a task the uploaded files and index of another task.
+
+    Uploads and indexes of single files are never rewritten, so they are
+    hard linked where possible. The index of all files is rewritten on
+    reindex, so it is copied.
+    """
+    for source_file_id, name in _get_task_file_names(source_id):
+        _link_file(
+            get_upload_file_path(source_id, f"{source_file_id}-{name}"),
+            get_upload_file_path(
+                target_id, f"{file_ids[source_file_id]}-{name}"
+            ),
+        )
+
+    source_dir = get_index_dir_path(source_id)
+    target_dir = get_index_dir_path(target_id)
+    for name in os.listdir(source_dir):
+        path = os.path.join(source_dir, name)
+        if not os.path.isdir(path):
+            shutil.copy2(path, os.path.join(target_dir, name))
+        elif name.isdigit() and int(name) in file_ids:
+            # Index of a single file, see APP_INDEX_PER_FILE
+            shutil.copytree(
+                path,
+                os.path.join(target_dir, str(file_ids[int(name)])),
+                copy_function=_link_file,
+                dirs_exist_ok=True,
+            )
+
+
+def _index_shared_files(ids: list[int]) -> None:
+    """Index the files shared by tasks once, on the first task, and clone it."""
+    source_id = ids[0]
+    source_files = _get_task_file_names(source_id)
+    if len(source_files) == 0:
+        return
+
+    texts = reindex(source_id)
+    log.debug("_index_shared_files(): Reindexed task with id=%d", source_id)
+
+    for id_ in ids:
+        target_files = _get_task_file_names(id_)
+        file_ids = {
+            source[0]: target[0]
+            for source, target in zip(source_files, target_files, strict=True)
+        }
+        _add_task_files_text(
+            id_,
+            target_files,
+            {
+                f"{file_ids[file_id]}-{name}": texts[f"{file_id}-{name}"]
+                for file_id, name in source_files
+                if f"{file_id}-{name}" in texts
+            },
+        )
+        if id_ != source_id:
+            _clone_task_files(source_id, id_, file_ids)
 
 
 def get_task(id_: int) -> ReadTaskResponse | None:
@@ -239,12 +337,81 @@ def get_task(id_: int) -> ReadTaskResponse | None:
 
 
 def create_task(data: CreateTaskRequest) -> TaskActionResponse:
+    check_collections(data.collections)
     id_ = _add_task()
     _add_task_conversation(id_, data)
+    _add_task_collections(id_, data.collections)
     _add_task_files(id_, data)
     return _query_task(id_)
 
 
+def create_tasks(data: CreateTasksRequest) -> CreateTasksResponse:
+    """Create a task per question, with one transaction per shard.
+
+    Shared files are saved once here and indexed once by `run_tasks()`.
+    """
+    if len(data.questions) == 0:
+        raise ValueError("No questions")
+    check_collections(data.collections)
+
+    now = datetime.now()
+    ids = allocate_task_ids(len(data.questions))
+    shards: dict[int, list[tuple[int, str]]] = {}
+    for id_, question in zip(ids, data.questions, strict=True):
+        shards.setdefault(get_task_shard(id_), []).append((id_, question))
+
+    for shard, tasks in shards.items():
+        with connect_shard(shard) as connection:
+            connection.executemany(
+                "INSERT INTO tasks (id, status, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                ((id_, TaskStatus.created, now, now) for id_, _ in tasks),
+            )
+            connection.executemany(
+                "INSERT INTO task_conversations (task_id, question, generated_at) VALUES (?, ?, ?)",
+                ((id_, question, now) for id_, question in tasks),
+            )
+            connection.executemany(
+                "INSERT INTO task_files (task_id, name, size, content_type, uploaded_at) VALUES (?, ?, ?, ?, ?)",
+                (
+                    (id_, file.filename, file.size, file.content_type, now)
+                    for id_, _ in tasks
+                    for file in data.files
+                ),
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO task_collections (task_id, collection_id) VALUES (?, ?)",
+                (
+                    (id_, collection_id)
+                    for id_, _ in tasks
+                    for collection_id in data.collections
+                ),
+            )
+        log.debug(
+            "create_tasks(): Added %d tasks to shard %d", len(tasks), shard
+        )
+
+    for (file_id, name), file in zip(
+        _get_task_file_names(ids[0]), data.files, strict=True
+    ):
+        with closing(
+            open(get_upload_file_path(ids[0], f"{file_id}-{name}"), "wb")
+        ) as out_, closing(file.file) as in_:
+            out_.write(in_.read())
+        log.debug("create_tasks(): Saved file %s", name)
+
+    return CreateTasksResponse(
+        tasks=[
+            TaskActionResponse(
+                id=id_,
+                status=TaskStatus.created,
+                created_at=now,
+                updated_at=now,
+            )
+            for id_ in ids
+        ]
+    )
+
+
 def update_task(id_: int, data: UpdateTaskRequest) -> TaskActionResponse:
     if _get_task_status(id_) is TaskStatus.completed:
         _add_task_conversation(id_, data)
@@ -256,23 +423,43 @@ def update_task(id_: int, data: UpdateTaskRequest) -> TaskActionResponse:
 
 async def run_task(id_: int) -> None:
     """Run a task."""
-    task = _query_task(id_, extras=True)
-    if task.status is not TaskStatus.started:
-        try:
-            _update_task_status(id_, TaskStatus.started)
-            log.debug("Running task %d", id_)
-
-            answer = (
-                run_chat(task.conversations, id_)
-                if len(task.files) == 0
-                else run_ask(task.conversations, id_)
-            )
-            _update_task_answer(id_, answer.response)
+    with track(f"run_task {id_}"):
+        task = _query_task(id_, extras=True)
+        if task.status is not TaskStatus.started:
+            try:
+                _update_task_status(id_, TaskStatus.started)
+                log.debug("Running task %d", id_)
+
+                answer = await (
+                    arun_chat(task.conversations, id_)
+                    if len(task.files) == 0 and len(task.collections) == 0
+                    else arun_ask(task.conversations, id_, task.collections)
+                )
+                _update_task_answer(id_, answer.response)
 
-            log.debug("Completed task %d", id_)
-        except Exception as e:
-            log.exception("Error running task %d: %s", id_, e)
-        finally:
+                log.debug("Completed task %d", id_)
+            except Exception as e:
+                log.exception("Error running task %d: %s", id_, e)
+            finally:
+                _update_task_status(id_, TaskStatus.completed)
+        else:
+            log.warning("Task %d already started", id_)
+
+
+async def run_tasks(ids: list[int]) -> None:
+    """Run tasks created together, after indexing their shared files once."""
+    try:
+        await asyncio.to_thread(_index_shared_files, ids)
+    except Exception as e:
+        log.exception("Error indexing files of tasks %s: %s", ids, e)
+        for id_ in ids:
             _update_task_status(id_, TaskStatus.completed)
-    else:
-        log.warning("Task %d already started", id_)
+        return
+
+    semaphore = asyncio.Semaphore(int(os.getenv("APP_TASK_CONCURRENCY", "16")))
+
+    async def run(id_: int) -> None:
+        async with semaphore:
+            await run_task(id_)
+
+    await asyncio.gather(*(run(id_) for id_ in ids))
@@ -0,0 +1,490 @@
+"""Transfer service, i.e. bulk export and import of tasks as NDJSON.
+
+An export is a stream of JSON records, one per line, grouped by task: the
+task itself with the IDs of the collections it asks against, then its
+conversations, its files and finally the contents of its uploaded files and
+index as base64 encoded chunks. Both directions work one task at a time, so
+memory use does not grow with the number of tasks. Collections themselves
+are not exported, as they are shared rather than owned by tasks. Nor are
+links to them imported, as collection IDs are only meaningful in the
+deployment they come from; the links dropped are reported instead.
+"""
+
+import base64
+import json
+import logging
+import os
+import shutil
+from collections.abc import AsyncIterator, Iterable, Iterator
+from contextlib import closing
+from dataclasses import dataclass, field
+from typing import Any, BinaryIO
+
+from ..models.tasks import TaskStatus
+from ..support.llm import reindex
+from ..support.paths import (
+    get_index_dir_path,
+    get_upload_dir_path,
+    get_upload_file_path,
+)
+from ..support.store import (
+    allocate_task_id,
+    connect_catalog,
+    connect_shard,
+    connect_task,
+    get_task_shard,
+    release_task_id,
+    write_task,
+)
+
+log = logging.getLogger("services.transfer")
+
+CHUNK_SIZE = 48 * 1024
+PAGE_SIZE = 500
+# Longest record accepted, e.g. a file with all of its extracted text
+MAX_LINE_SIZE = 64 * 1024 * 1024
+
+
+def _to_line(record: dict[str, Any]) -> str:
+    # str() keeps timestamps in the format sqlite3 parses back
+    return json.dumps(record, default=str) + "\n"
+
+
+def _iter_task_ids(ids: list[int] | None) -> Iterator[int]:
+    if ids is not None:
+        yield from ids
+        return
+    last_id = 0
+    while True:
+        with closing(connect_catalog().cursor()) as cursor:
+            page = [
+                row[0]
+                for row in cursor.execute(
+                    "SELECT id FROM task_shards WHERE id > ? AND shard >= 0 ORDER BY id LIMIT ?",
+                    (last_id, PAGE_SIZE),
+                )
+            ]
+        if len(page) == 0:
+            return
+        yield from page
+        last_id = page[-1]
+
+
+def _iter_blob(
+    task_id: int, kind: str, relpath: str, path: str
+) -> Iterator[str]:
+    with open(path, "rb") as in_:
+        while chunk := in_.read(CHUNK_SIZE):
+            yield _to_line(
+                {
+                    "type": "blob",
+                    "task_id": task_id,
+                    "kind": kind,
+                    "path": relpath,
+                    "data": base64.b64encode(chunk).decode("ascii"),
+                }
+            )
+
+
+def _iter_task(id_: int, include_index: bool) -> Iterator[str]:
+    with connect_task(id_) as connection, closing(
+        connection.cursor()
+    ) as cursor:
+        task = cursor.execute(
+            "SELECT id, status, summary, created_at, updated_at FROM tasks WHERE id = ?",
+            (id_,),
+        ).fetchone()
+        if task is None:
+            return
+        conversations = cursor.execute(
+            "SELECT question, answer, generated_at FROM task_conversations WHERE task_id = ? ORDER BY id ASC",
+            (id_,),
+        ).fetchall()
+        collections = [
+            row[0]
+            for row in cursor.execute(
+                "SELECT collection_id FROM task_collections WHERE task_id = ? ORDER BY collection_id ASC",
+                (id_,),
+            )
+        ]
+        files = cursor.execute(
+            "SELECT f.id, f.name, f.size, f.content_type, f.uploaded_at, t.content FROM task_files f LEFT JOIN task_files_fts t ON t.rowid = f.id WHERE f.task_id = ? ORDER BY f.id ASC",
+            (id_,),
+        ).fetchall()
+
+    yield _to_line(
+        dict(
+            zip(
+                (
+                    "type",
+                    "id",
+                    "status",
+                    "summary",
+                    "created_at",
+                    "updated_at",
+                    "collections",
+                ),
+                ("task", *task, collections),
+                strict=True,
+            )
+        )
+    )
+    for conversation in conversations:
+        yield _to_line(
+            dict(
+                zip(
+                    ("type", "task_id", "question", "answer", "generated_at"),
+                    ("conversation", id_, *conversation),
+                    strict=True,
+                )
+            )
+        )
+    for file in files:
+        yield _to_line(
+            dict(
+                zip(
+                    (
+                        "type",
+                        "task_id",
+                        "id",
+                        "name",
+                        "size",
+                        "content_type",
+                        "uploaded_at",
+                        "text",
+                    ),
+                    ("file", id_, *file),
+                    strict=True,
+                )
+            )
+        )
+    for file in files:
+        filename = f"{file[0]}-{file[1]}"
+        path = get_upload_file_path(id_, filename)
+        if os.path.exists(path):
+            yield from _iter_blob(id_, "upload", filename, path)
+    if include_index:
+        index_dir = get_index_dir_path(id_)
+        for dirpath, _, filenames in os.walk(index_dir):
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                yield from _iter_blob(
+                    id_, "index", os.path.relpath(path, index_dir), path
+                )
+
+
+def export_tasks(
+    ids: list[int] | None = None, include_index: bool = True
+) -> Iterator[str]:
+    """Export tasks, all of them by default, as NDJSON lines."""
+    for id_ in _iter_task_ids(ids):
+        log.debug("export_tasks(): Exporting task with id=%d", id_)
+        yield from _iter_task(id_, include_index)
+
+
+def _check_relpath(relpath: str) -> list[str]:
+    parts = os.path.normpath(relpath).split(os.sep)
+    if os.path.isabs(relpath) or ".." in parts or "" in parts:
+        raise ValueError(f"Invalid path {relpath}")
+    return parts
+
+
+@dataclass
+class TaskImport:
+    """State of an import of tasks under new task and file IDs.
+
+    Each task is imported on its own. Its rows are buffered until they are
+    complete, i.e. until its first blob or the next task, then written in a
+    single transaction, so that no transaction waits on the records still to
+    come. A task left incomplete by an error is removed by `abort_import()`,
+    while the tasks before it stay imported, as listed in `ids`.
+
+    Unless `reuse_index` is set and the export carries index data, each
+    imported task with files is reindexed once its records are complete.
+    """
+
+    reuse_index: bool = False
+    tasks: int = 0
+    files: int = 0
+    # New IDs of the tasks imported so far
+    ids: list[int] = field(default_factory=list)
+    # Exported collection IDs of the imported tasks, by new task ID
+    unlinked_collections: dict[int, list[int]] = field(default_factory=dict)
+    # Current task, i.e. the one the following records belong to
+    task_id: int | None = None
+    old_task_id: int | None = None
+    rows: list[tuple[str, tuple]] = field(default_factory=list)
+    file_records: list[dict[str, Any]] = field(default_factory=list)
+    file_ids: dict[int, int] = field(default_factory=dict)
+    written: bool = False
+    has_index: bool = False
+    out_: BinaryIO | None = None
+    out_path: str | None = None
+
+
+def _write_task(import_: TaskImport) -> None:
+    """Write the buffered rows of the current task, assigning file IDs."""
+    if import_.written:
+        return
+    # A new task, routed as cached when its ID was allocated
+    with connect_shard(get_task_shard(import_.task_id)) as connection:
+        for sql, params in import_.rows:
+            connection.execute(sql, params)
+        for record in import_.file_records:
+            file_id = connection.execute(
+                "INSERT INTO task_files (task_id, name, size, content_type, uploaded_at) VALUES (?, ?, ?, ?, ?)",
+                (
+                    import_.task_id,
+                    record["name"],
+                    record["size"],
+                    record["content_type"],
+                    record["uploaded_at"],
+                ),
+            ).lastrowid
+            if record.get("text") is not None:
+                connection.execute(
+                    "INSERT INTO task_files_fts (rowid, name, content) VALUES (?, ?, ?)",
+                    (file_id, record["name"], record["text"]),
+                )
+            import_.file_ids[record["id"]] = file_id
+    import_.written = True
+
+
+def _close_out(import_: TaskImport) -> None:
+    if import_.out_ is not None:
+        import_.out_.close()
+    import_.out_ = None
+    import_.out_path = None
+
+
+def _reset_task(import_: TaskImport) -> None:
+    import_.task_id = None
+    import_.old_task_id = None
+    import_.rows = []
+    import_.file_records = []
+    import_.file_ids = {}
+    import_.written = False
+    import_.has_index = False
+
+
+def _finish_task(import_: TaskImport) -> None:
+    if import_.task_id is None:
+        return
+    _write_task(import_)
+    _close_out(import_)
+    if len(import_.file_ids) > 0 and not (
+        import_.reuse_index and import_.has_index
+    ):
+        reindex(import_.task_id)
+    import_.ids.append(import_.task_id)
+    import_.tasks += 1
+    import_.files += len(import_.file_ids)
+    _reset_task(import_)
+
+
+def _remove_task(import_: TaskImport) -> None:
+    """Remove the current task, left incomplete, and free its ID."""
+    _close_out(import_)
+    id_ = import_.task_id
+    if import_.written:
+        with write_task(id_) as connection:
+            connection.execute(
+                "DELETE FROM task_conversations WHERE task_id = ?", (id_,)
+            )
+            connection.execute(
+                "DELETE FROM task_files WHERE task_id = ?", (id_,)
+            )
+            connection.execute(
+                "DELETE FROM task_collections WHERE task_id = ?", (id_,)
+            )
+            connection.execute("DELETE FROM tasks WHERE id = ?", (id_,))
+    shutil.rmtree(get_upload_dir_path(id_), ignore_errors=True)
+    shutil.rmtree(get_index_dir_path(id_), ignore_errors=True)
+    release_task_id(id_)
+    import_.unlinked_collections.pop(id_, None)
+    log.debug("_remove_task(): Removed incomplete task %d", id_)
+    _reset_task(import_)
+
+
+def _import_task(import_: TaskImport, record: dict[str, Any]) -> None:
+    _finish_task(import_)
+    import_.old_task_id = record["id"]
+    import_.task_id = allocate_task_id()
+    import_.rows.append(
+        (
+            "INSERT INTO tasks (id, status, summary, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (
+                import_.task_id,
+                # Nothing resumes a task exported while running, so it is
+                # imported as if it had failed, i.e. without an answer
+                TaskStatus.completed
+                if record["status"] == TaskStatus.started
+                else record["status"],
+                record.get("summary"),
+                record["created_at"],
+                record["updated_at"],
+            ),
+        )
+    )
+    _import_task_collections(import_, record.get("collections", []))
+    log.debug(
+        "_import_task(): Importing task %d as %d",
+        import_.old_task_id,
+        import_.task_id,
+    )
+
+
+def _import_task_collections(
+    import_: TaskImport, collection_ids: list[int]
+) -> None:
+    # The same ID here is most likely another collection, so never relink
+    if len(collection_ids) > 0:
+        log.warning(
+            "_import_task_collections(): Dropping links of task %d to collections %s",
+            import_.old_task_id,
+            collection_ids,
+        )
+        import_.unlinked_collections[import_.task_id] = collection_ids
+
+
+def _import_conversation(import_: TaskImport, record: dict[str, Any]) -> None:
+    if import_.written:
+        raise ValueError("Conversation record follows blobs")
+    import_.rows.append(
+        (
+            "INSERT INTO task_conversations (task_id, question, answer, generated_at) VALUES (?, ?, ?, ?)",
+            (
+                import_.task_id,
+                record["question"],
+                record.get("answer"),
+                record["generated_at"],
+            ),
+        )
+    )
+
+
+def _import_file(import_: TaskImport, record: dict[str, Any]) -> None:
+    if import_.written:
+        raise ValueError("File record follows blobs")
+    if len(_check_relpath(record["name"])) > 1:
+        raise ValueError(f"Invalid file name {record['name']}")
+    import_.file_records.append(record)
+
+
+def _get_blob_path(import_: TaskImport, record: dict[str, Any]) -> str | None:
+    parts = _check_relpath(record["path"])
+    if record["kind"] == "upload":
+        file_id, _, name = parts[0].partition("-")
+        if len(parts) > 1 or not file_id.isdigit():
+            raise ValueError(f"Invalid upload path {record['path']}")
+        return get_upload_file_path(
+            import_.task_id, f"{import_.file_ids[int(file_id)]}-{name}"
+        )
+    if record["kind"] == "index":
+        if not import_.reuse_index:
+            return None
+        if len(parts) > 1 and parts[0].isdigit():
+            # Index of a single file, see APP_INDEX_PER_FILE
+            if int(parts[0]) not in import_.file_ids:
+                return None
+            parts[0] = str(import_.file_ids[int(parts[0])])
+        import_.has_index = True
+        path = os.path.join(get_index_dir_path(import_.task_id), *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+    raise ValueError(f"Unknown blob kind {record['kind']}")
+
+
+def _import_blob(import_: TaskImport, record: dict[str, Any]) -> None:
+    _write_task(import_)
+    path = _get_blob_path(import_, record)
+    if path is None:
+        return
+    if path != import_.out_path:
+        _close_out(import_)
+        import_.out_ = open(path, "wb")  # noqa: SIM115
+        import_.out_path = path
+    import_.out_.write(base64.b64decode(record["data"]))
+
+
+def add_records(
+    import_: TaskImport, records: Iterable[dict[str, Any]]
+) -> None:
+    """Import exported records in order."""
+    for record in records:
+        if record["type"] == "task":
+            _import_task(import_, record)
+            continue
+        if import_.task_id is None or record["task_id"] != import_.old_task_id:
+            raise ValueError("Record does not follow its task")
+        if record["type"] == "conversation":
+            _import_conversation(import_, record)
+        elif record["type"] == "file":
+            _import_file(import_, record)
+        elif record["type"] == "blob":
+            _import_blob(import_, record)
+        else:
+            raise ValueError(f"Unknown record type {record['type']}")
+
+
+def close_import(import_: TaskImport) -> None:
+    """Complete an import, finishing the last task."""
+    try:
+        _finish_task(import_)
+    finally:
+        _close_out(import_)
+
+
+def abort_import(import_: TaskImport) -> None:
+    """Abandon an import, removing the task left incomplete."""
+    if import_.task_id is not None:
+        _remove_task(import_)
+
+
+async def aiter_records(
+    chunks: AsyncIterator[bytes],
+) -> AsyncIterator[dict[str, Any]]:
+    """Parse records from a stream of NDJSON, e.g. a request body.
+
+    Raises:
+        ValueError: If a line is longer than `MAX_LINE_SIZE` bytes.
+    """
+    # Parts of the line being received, only joined once it is complete
+    parts: list[bytes] = []
+    size = 0
+    async for chunk in chunks:
+        *lines, tail = chunk.split(b"\n")
+        for line in lines:
+            if parts:
+                line = b"".join((*parts, line))
+                parts = []
+            if len(line) > MAX_LINE_SIZE:
+                raise ValueError("Record too long")
+            if line.strip():
+                yield json.loads(line)
+        if lines:
+            size = 0
+        size += len(tail)
+        if size > MAX_LINE_SIZE:
+            raise ValueError("Record too long")
+        if tail:
+            parts.append(tail)
+    line = b"".join(parts)
+    if line.strip():
+        yield json.loads(line)
+
+
+def import_tasks(
+    lines: Iterable[str], reuse_index: bool = False
+) -> TaskImport:
+    """Import tasks from NDJSON lines as exported by `export_tasks()`."""
+    import_ = TaskImport(reuse_index)
+    try:
+        add_records(
+            import_, (json.loads(line) for line in lines if line.strip())
+        )
+        close_import(import_)
+    except Exception:
+        abort_import(import_)
+        raise
+    return import_
@@ -1,15 +1,20 @@
 """Functions for utilising LLMs."""
 
+import asyncio
 import logging as log
 import os
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from typing import Any
 
-from langchain.chat_models import ChatOpenAI
+import aiohttp
+import openai
 from llama_index import (
     Document,
     GPTVectorStoreIndex,
-    LLMPredictor,
     OpenAIEmbedding,
+    QueryBundle,
     Response,
     ServiceContext,
     SimpleDirectoryReader,
@@ -17,10 +22,20 @@ from llama_index import (
     load_index_from_storage,
 )
 from llama_index.chat_engine import SimpleChatEngine
-from llama_index.llms import ChatMessage, MessageRole
+from llama_index.chat_engine.types import BaseChatEngine
+from llama_index.llms import ChatMessage, MessageRole, OpenAI
+from llama_index.response_synthesizers import get_response_synthesizer
+from llama_index.schema import NodeWithScore
 
 from ..models.tasks import TaskConversation
-from .paths import get_index_dir_path, get_upload_dir_path
+from .paths import (
+    get_collection_index_dir_path,
+    get_collection_upload_dir_path,
+    get_file_index_dir_path,
+    get_index_dir_path,
+    get_upload_dir_path,
+)
+from .profiling import track
 
 PROMPT_USER_QUESTION = """
 You are an AI assistant helping a human to find information in a collection of documents.
@@ -41,14 +56,21 @@ PROMPT_AGENT_SELECTION = """
 """
 
 
+# Shared HTTP session for async OpenAI calls, created lazily on the event loop
+_aiosession: aiohttp.ClientSession | None = None
+
+
 # def _get_model() -> OpenAI:
 #     return OpenAI(temperature=0, model_name="text-davinci-003")
 
 
-def _get_chat_model() -> ChatOpenAI:
-    return ChatOpenAI(
+def _get_chat_model() -> OpenAI:
+    # Unlike LangChain's models wrapped by llama_index, this one has truly
+    # async methods, calling the API through `openai.aiosession`
+    return OpenAI(
         temperature=0,
         model="gpt-3.5-turbo",
+        api_key=os.environ["OPENAI_API_KEY"],
     )
 
 
@@ -57,10 +79,6 @@ def _get_embedding_model() -> Any:
     return OpenAIEmbedding(api_key=os.environ["OPENAI_API_KEY"])
 
 
-def _get_llm_predictor() -> LLMPredictor:
-    return LLMPredictor(llm=_get_chat_model())
-
-
 def _get_default_storage_context() -> StorageContext:
     return StorageContext.from_defaults()
 
@@ -69,9 +87,21 @@ def _get_storage_context(id_: int) -> StorageContext:
     return StorageContext.from_defaults(persist_dir=get_index_dir_path(id_))
 
 
+def _get_file_storage_context(id_: int, file_id: int) -> StorageContext:
+    return StorageContext.from_defaults(
+        persist_dir=get_file_index_dir_path(id_, file_id)
+    )
+
+
+def _is_index_per_file() -> bool:
+    """Whether to index every file of a task separately and query them concurrently."""
+    return os.getenv("APP_INDEX_PER_FILE", "false").lower() in ("1", "true")
+
+
+@lru_cache(maxsize=1)
 def _get_service_context() -> ServiceContext:
     return ServiceContext.from_defaults(
-        llm_predictor=_get_llm_predictor(), embed_model=_get_embedding_model()
+        llm=_get_chat_model(), embed_model=_get_embedding_model()
     )
 
 
@@ -82,6 +112,52 @@ def _load_index_from_storage(id_: int) -> GPTVectorStoreIndex:
     )
 
 
+def _load_file_index_from_storage(
+    id_: int, file_id: int
+) -> GPTVectorStoreIndex:
+    return load_index_from_storage(
+        storage_context=_get_file_storage_context(id_, file_id),
+        service_context=_get_service_context(),
+    )
+
+
+def _load_collection_file_index(id_: int, file_id: int) -> GPTVectorStoreIndex:
+    return load_index_from_storage(
+        storage_context=StorageContext.from_defaults(
+            persist_dir=os.path.join(
+                get_collection_index_dir_path(id_), str(file_id)
+            )
+        ),
+        service_context=_get_service_context(),
+    )
+
+
+@lru_cache(maxsize=1)
+def _get_collection_index_cache() -> Callable[[int, int], GPTVectorStoreIndex]:
+    """Get a loader of collection file indexes, keeping the recent ones.
+
+    The index of a file is never rewritten once persisted, so a loaded one
+    can be shared by all tasks asking against the collection.
+    """
+    return lru_cache(
+        maxsize=int(os.getenv("APP_COLLECTION_CACHE_SIZE", "64"))
+    )(_load_collection_file_index)
+
+
+@lru_cache(maxsize=1)
+def _get_load_executor() -> ThreadPoolExecutor:
+    """Get the executor loading indexes to ask against.
+
+    Loads cannot be stopped once started, e.g. when their sub-query is
+    dropped, so they get their own bounded pool rather than piling up in
+    the default one.
+    """
+    return ThreadPoolExecutor(
+        max_workers=int(os.getenv("APP_ASK_CONCURRENCY", "8")),
+        thread_name_prefix="index-load",
+    )
+
+
 def _create_index(documents: list[Document]) -> GPTVectorStoreIndex:
     # Use default storage and service context to initialise index purely for persisting
     return GPTVectorStoreIndex.from_documents(
@@ -95,15 +171,107 @@ def _persist_index(index: GPTVectorStoreIndex, id_: int) -> None:
     index.storage_context.persist(persist_dir=get_index_dir_path(id_))
 
 
-def reindex(id_: int) -> None:
-    """Reindex documents for a task."""
-    try:
-        documents = SimpleDirectoryReader(get_upload_dir_path(id_)).load_data()
-        log.debug("docs to index, %s", len(documents))
-        index = _create_index(documents)
-        _persist_index(index, id_)
-    except Exception as e:
-        log.exception("Error indexing docs for task %d: %s", id_, e)
+def _read_file(path: str) -> list[Document]:
+    return SimpleDirectoryReader(input_files=[path]).load_data()
+
+
+def _to_text(documents: list[Document]) -> str:
+    return "\n".join(document.text for document in documents)
+
+
+def extract_text(path: str) -> str:
+    """Extract the text of a file, as read for indexing."""
+    return _to_text(_read_file(path))
+
+
+def _get_indexed_file_ids(index_dir: str) -> list[int]:
+    """Get the IDs of the files that have their own index in a directory."""
+    return sorted(
+        int(name)
+        for name in os.listdir(index_dir)
+        if name.isdigit()
+        and os.path.exists(os.path.join(index_dir, name, "docstore.json"))
+    )
+
+
+def _reindex_per_file(upload_dir: str, index_dir: str) -> dict[str, str]:
+    """Index each uploaded file on its own, skipping indexed ones.
+
+    Returns:
+        The text of each file indexed, by file name.
+    """
+    indexed = set(_get_indexed_file_ids(index_dir))
+    texts = {}
+    for filename in sorted(os.listdir(upload_dir)):
+        # Uploaded files are named "<task_files.id>-<name>", or
+        # "<collection_files.id>-<name>" in a collection
+        file_id, _, _ = filename.partition("-")
+        if not file_id.isdigit() or int(file_id) in indexed:
+            continue
+        try:
+            documents = _read_file(os.path.join(upload_dir, filename))
+            index = _create_index(documents)
+            index.storage_context.persist(
+                persist_dir=os.path.join(index_dir, file_id)
+            )
+            texts[filename] = _to_text(documents)
+        except Exception as e:
+            log.exception(
+                "Error indexing %s in %s: %s", filename, upload_dir, e
+            )
+    return texts
+
+
+def _read_upload_dir(upload_dir: str) -> dict[str, list[Document]]:
+    """Read the uploaded files in a directory, skipping unreadable ones."""
+    documents = {}
+    for filename in sorted(os.listdir(upload_dir)):
+        path = os.path.join(upload_dir, filename)
+        # Hidden files are partial writes, e.g. of a task being moved
+        if filename.startswith(".") or not os.path.isfile(path):
+            continue
+        try:
+            documents[filename] = _read_file(path)
+        except Exception as e:
+            log.exception("Error reading %s: %s", path, e)
+    return documents
+
+
+def reindex(id_: int) -> dict[str, str]:
+    """Reindex documents for a task.
+
+    Returns:
+        The text of each file read for indexing, by file name, so that
+        callers need not parse the files again.
+    """
+    with track(f"reindex {id_}"):
+        try:
+            if _is_index_per_file():
+                return _reindex_per_file(
+                    get_upload_dir_path(id_), get_index_dir_path(id_)
+                )
+            documents = _read_upload_dir(get_upload_dir_path(id_))
+            log.debug("docs to index, %s", len(documents))
+            index = _create_index(
+                [doc for docs in documents.values() for doc in docs]
+            )
+            _persist_index(index, id_)
+            return {
+                filename: _to_text(docs)
+                for filename, docs in documents.items()
+            }
+        except Exception as e:
+            log.exception("Error indexing docs for task %d: %s", id_, e)
+            return {}
+
+
+def reindex_collection(id_: int) -> None:
+    """Index the files of a collection not indexed yet, each on its own."""
+    with track(f"reindex_collection {id_}"):
+        _reindex_per_file(
+            get_collection_upload_dir_path(id_),
+            get_collection_index_dir_path(id_),
+        )
 
 
 def _convert_to_chat_data(
@@ -123,26 +291,188 @@ def _convert_to_chat_data(
     return (input_, history)
 
 
-def run_chat(conversations: list[TaskConversation], id_: int) -> Response:
-    """Chat directly with a LLM with history."""
-    engine = SimpleChatEngine.from_defaults(
+def _get_aiosession() -> aiohttp.ClientSession:
+    """Get the pooled HTTP session and bind it to the current async context."""
+    global _aiosession
+    if _aiosession is None or _aiosession.closed:
+        _aiosession = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=int(os.getenv("APP_LLM_MAX_CONNECTIONS", "100"))
+            )
+        )
+    # The openai client only reuses a session set in the calling context
+    openai.aiosession.set(_aiosession)
+    return _aiosession
+
+
+async def close_clients() -> None:
+    """Close the pooled HTTP session used by async LLM calls."""
+    global _aiosession
+    if _aiosession is not None and not _aiosession.closed:
+        await _aiosession.close()
+    _aiosession = None
+
+
+def _get_chat_engine() -> SimpleChatEngine:
+    return SimpleChatEngine.from_defaults(
         service_context=_get_service_context()
     )
-    output = engine.chat(*_convert_to_chat_data(conversations))
+
+
+async def _aget_ask_engine(id_: int) -> BaseChatEngine:
+    # Loading the index reads and parses its files, so keep it off the loop
+    index = await asyncio.to_thread(_load_index_from_storage, id_)
+    return index.as_chat_engine(
+        verbose=True, similarity_top_k=3, vector_store_query_mode="default"
+    )
+
+
+async def arun_chat(
+    conversations: list[TaskConversation], id_: int
+) -> Response:
+    """Chat directly with a LLM with history, without blocking the event loop."""
+    _get_aiosession()
+    engine = _get_chat_engine()
+    output = await engine.achat(*_convert_to_chat_data(conversations))
 
     log.debug("(Chat) task: %d, answer: %s", id_, output)
     return output
 
 
-def run_ask(
+async def _aretrieve(
+    id_: int,
+    loaders: list[Callable[[], GPTVectorStoreIndex]],
+    question: str,
+) -> list[NodeWithScore]:
+    """Query the indexes given by the loaders concurrently and keep the best nodes.
+
+    Sub-queries still running after `APP_ASK_BUDGET_SECONDS` are dropped.
+    """
+    query = QueryBundle(query_str=question)
+    # Embed the question once rather than once per file
+    embed_model = _get_service_context().embed_model
+    query.embedding = await embed_model.aget_agg_embedding_from_queries(
+        query.embedding_strs
+    )
+    semaphore = asyncio.Semaphore(int(os.getenv("APP_ASK_CONCURRENCY", "8")))
+
+    async def retrieve(
+        load: Callable[[], GPTVectorStoreIndex]
+    ) -> list[NodeWithScore]:
+        async with semaphore:
+            index = await asyncio.get_running_loop().run_in_executor(
+                _get_load_executor(), load
+            )
+            return await index.as_retriever(similarity_top_k=3).aretrieve(
+                query
+            )
+
+    tasks = [asyncio.create_task(retrieve(load)) for load in loaders]
+    done, pending = await asyncio.wait(
+        tasks, timeout=float(os.getenv("APP_ASK_BUDGET_SECONDS", "10"))
+    )
+    for task in pending:
+        task.cancel()
+    if pending:
+        log.warning(
+            "(Ask) task: %d, dropped %d slow sub-queries", id_, len(pending)
+        )
+
+    nodes = []
+    for task in done:
+        if task.exception() is None:
+            nodes.extend(task.result())
+        else:
+            log.warning(
+                "(Ask) task: %d, sub-query failed: %s", id_, task.exception()
+            )
+    nodes.sort(key=lambda node: node.score or 0.0, reverse=True)
+    return nodes[: int(os.getenv("APP_ASK_TOP_K", "5"))]
+
+
+async def _arun_ask_indexes(
     conversations: list[TaskConversation],
     id_: int,
+    loaders: list[Callable[[], GPTVectorStoreIndex]],
 ) -> Response:
-    """Ask questions with a LLM against existing index(es) of the documents plus history."""
-    index = _load_index_from_storage(id_)
-    engine = index.as_chat_engine(
-        verbose=True, similarity_top_k=3, vector_store_query_mode="default"
+    input_, history = _convert_to_chat_data(conversations)
+    nodes = await _aretrieve(id_, loaders, input_)
+    log.debug("(Ask) task: %d, merged %d nodes", id_, len(nodes))
+    if len(nodes) == 0:
+        # The synthesizer would answer "Empty Response" without asking
+        log.warning("(Ask) task: %d, no passages, answering without them", id_)
+        return await arun_chat(conversations, id_)
+
+    synthesizer = get_response_synthesizer(
+        service_context=_get_service_context()
+    )
+    return await synthesizer.asynthesize(
+        PROMPT_USER_QUESTION.format(
+            history="\n".join(f"{m.role.value}: {m.content}" for m in history),
+            input=input_,
+        ),
+        nodes,
     )
-    output = engine.chat(*_convert_to_chat_data(conversations))
+
+
+def _has_index(id_: int) -> bool:
+    """Whether a task has a single index of all its files."""
+    return os.path.exists(
+        os.path.join(get_index_dir_path(id_), "docstore.json")
+    )
+
+
+def _get_index_loaders(
+    id_: int, collection_ids: list[int]
+) -> list[Callable[[], GPTVectorStoreIndex]]:
+    """Get loaders of the indexes of the collections and, if any, the task.
+
+    Without collections, the task's own index is only split in loaders if
+    it is indexed per file. A task with a single index, e.g. one indexed
+    before `APP_INDEX_PER_FILE` was set, is asked against that one.
+    """
+    loaders = [
+        partial(_get_collection_index_cache(), collection_id, file_id)
+        for collection_id in collection_ids
+        for file_id in _get_indexed_file_ids(
+            get_collection_index_dir_path(collection_id)
+        )
+    ]
+    file_ids = (
+        _get_indexed_file_ids(get_index_dir_path(id_))
+        if _is_index_per_file()
+        else []
+    )
+    if len(file_ids) > 0:
+        loaders.extend(
+            partial(_load_file_index_from_storage, id_, file_id)
+            for file_id in file_ids
+        )
+    elif (_is_index_per_file() or len(collection_ids) > 0) and _has_index(id_):
+        loaders.append(partial(_load_index_from_storage, id_))
+    return loaders
+
+
+async def arun_ask(
+    conversations: list[TaskConversation],
+    id_: int,
+    collection_ids: list[int] | None = None,
+) -> Response:
+    """Ask questions against the task's index and collections, without blocking the event loop."""
+    _get_aiosession()
+    collection_ids = collection_ids or []
+    loaders = _get_index_loaders(id_, collection_ids)
+    if len(loaders) > 0:
+        output = await _arun_ask_indexes(conversations, id_, loaders)
+        log.debug("(Ask) task: %d, answer: %s", id_, output)
+        return output
+    if not _has_index(id_):
+        # Nothing indexed to ask against yet, e.g. collections still being
+        # indexed, so answer from the conversation alone
+        log.warning("(Ask) task: %d, no indexes, answering without them", id_)
+        return await arun_chat(conversations, id_)
+
+    engine = await _aget_ask_engine(id_)
+    output = await engine.achat(*_convert_to_chat_data(conversations))
     log.debug("(Ask) task: %d, answer: %s", id_, output)
     return output
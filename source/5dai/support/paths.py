@@ -25,9 +25,15 @@ def _get_path(
     return os.path.join(dir_, filename) if filename else dir_
 
 
-def get_sqlite_file_path() -> str:
-    """Get the path to the SQLite database file."""
-    return _get_path(DataType.sqlite, filename="system.sqlite")
+def get_sqlite_file_path(shard: int = 0) -> str:
+    """Get the path to the SQLite database file of a shard."""
+    filename = "system.sqlite" if shard == 0 else f"system-{shard}.sqlite"
+    return _get_path(DataType.sqlite, filename=filename)
+
+
+def get_catalog_file_path() -> str:
+    """Get the path to the SQLite database file mapping tasks to shards."""
+    return _get_path(DataType.sqlite, filename="catalog.sqlite")
 
 
 def get_upload_dir_path(_id: int) -> str:
@@ -43,3 +49,25 @@ def get_upload_file_path(_id: int, filename: str) -> str:
 def get_index_dir_path(_id: int) -> str:
     """Get the path to the file index directory."""
     return _get_path(DataType.index, str(_id))
+
+
+def get_file_index_dir_path(_id: int, file_id: int) -> str:
+    """Get the path to the index directory of a single task file."""
+    return _get_path(DataType.index, os.path.join(str(_id), str(file_id)))
+
+
+def get_collection_upload_dir_path(_id: int) -> str:
+    """Get the path to the file upload directory of a collection."""
+    return _get_path(DataType.upload, os.path.join("collections", str(_id)))
+
+
+def get_collection_upload_file_path(_id: int, filename: str) -> str:
+    """Get the path to a file uploaded to a collection."""
+    return _get_path(
+        DataType.upload, os.path.join("collections", str(_id)), filename
+    )
+
+
+def get_collection_index_dir_path(_id: int) -> str:
+    """Get the path to the index directory of a collection."""
+    return _get_path(DataType.index, os.path.join("collections", str(_id)))
@@ -0,0 +1,290 @@
+"""Functions for sampling where time goes in the running service.
+
+Stacks are sampled from other threads with `sys._current_frames()`, so the
+profiled code runs unmodified and only pays for the GIL taken by each
+sample. Coroutines suspended on an `await`, e.g. a task waiting for the
+LLM, have no thread stack of their own and are sampled by following their
+await chain instead.
+
+Profiles are returned in the collapsed stack format, one line per distinct
+stack with frames separated by semicolons and followed by the number of
+samples, as read by flamegraph.pl, speedscope and the like.
+
+Calls wrapped in `track()` that run past `APP_PROFILE_SLOW_SECONDS` are
+sampled from then on by a watchdog thread, and their profiles are kept in
+a ring buffer of the last `APP_PROFILE_SLOW_CAPACITY` slow calls.
+"""
+
+import asyncio
+import logging as log
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from collections.abc import Coroutine, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from types import FrameType
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from ..models.profiling import SlowCall
+
+_lock = threading.Lock()
+_profile_lock = threading.Lock()
+_calls: dict[int, "_TrackedCall"] = {}
+_calls_active = threading.Event()
+_watchdog: threading.Thread | None = None
+_slow_calls: deque[SlowCall] | None = None
+
+
+@dataclass
+class _TrackedCall:
+    name: str
+    thread_id: int
+    task: asyncio.Task | None
+    started_at: datetime
+    start: float = field(default_factory=time.perf_counter)
+    stacks: Counter[str] = field(default_factory=Counter)
+
+
+def get_interval() -> float:
+    """Get the default sampling interval in seconds."""
+    return float(os.getenv("APP_PROFILE_INTERVAL_MS", "10")) / 1000
+
+
+def get_slow_threshold() -> float:
+    """Get the duration in seconds past which calls are recorded, 0 for never."""
+    return float(os.getenv("APP_PROFILE_SLOW_SECONDS", "5"))
+
+
+def _get_slow_calls() -> deque[SlowCall]:
+    global _slow_calls
+    if _slow_calls is None:
+        _slow_calls = deque(
+            maxlen=int(os.getenv("APP_PROFILE_SLOW_CAPACITY", "50"))
+        )
+    return _slow_calls
+
+
+def _shorten(filename: str) -> str:
+    # Make paths relative to the import root, e.g. "llama_index/indices/..."
+    prefixes = [p for p in sys.path if p and filename.startswith(p)]
+    if len(prefixes) == 0:
+        return filename
+    return os.path.relpath(filename, max(prefixes, key=len))
+
+
+def _format_frame(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({_shorten(code.co_filename)}:{frame.f_lineno})"
+
+
+def _format_thread_stack(frame: FrameType) -> list[str]:
+    stack = []
+    while frame is not None:
+        stack.append(_format_frame(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def _format_await_stack(coroutine: Coroutine | None) -> list[str]:
+    stack = []
+    while coroutine is not None:
+        frame = getattr(coroutine, "cr_frame", None) or getattr(
+            coroutine, "gi_frame", None
+        )
+        if frame is not None:
+            stack.append(_format_frame(frame))
+        coroutine = getattr(coroutine, "cr_await", None) or getattr(
+            coroutine, "gi_yieldfrom", None
+        )
+    return stack
+
+
+def _is_running(task: asyncio.Task) -> bool:
+    return getattr(task.get_coro(), "cr_running", False)
+
+
+def _format_stack(
+    frames: dict[int, FrameType], thread_id: int, task: asyncio.Task | None
+) -> str | None:
+    if task is not None and not _is_running(task):
+        stack = _format_await_stack(task.get_coro())
+    elif thread_id in frames:
+        stack = _format_thread_stack(frames[thread_id])
+    else:
+        return None
+    return ";".join(stack) if len(stack) > 0 else None
+
+
+def to_collapsed(stacks: Counter[str]) -> str:
+    """Format sampled stacks in the collapsed stack format."""
+    return "".join(
+        f"{stack} {count}\n" for stack, count in stacks.most_common()
+    )
+
+
+def _get_suspended_tasks(
+    loop: asyncio.AbstractEventLoop,
+) -> list[asyncio.Task]:
+    try:
+        return [t for t in asyncio.all_tasks(loop) if not _is_running(t)]
+    except RuntimeError:
+        # The set of tasks changed on the loop thread while being copied
+        return []
+
+
+def profile(
+    seconds: float,
+    interval: float,
+    loop: asyncio.AbstractEventLoop | None = None,
+) -> str:
+    """Sample all threads for a number of seconds, in the calling thread.
+
+    The stack of each thread is prefixed with its name. If `loop` is given,
+    its suspended tasks are also sampled, each prefixed with its name.
+    Only one profile runs at a time; a `RuntimeError` is raised otherwise.
+    """
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("A profile is already running")
+    try:
+        own_id = threading.get_ident()
+        stacks = Counter()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    stack = _format_thread_stack(frame)
+                    name = names.get(thread_id, str(thread_id))
+                    stacks[";".join([f"thread {name}", *stack])] += 1
+            if loop is not None:
+                for task in _get_suspended_tasks(loop):
+                    stack = _format_await_stack(task.get_coro())
+                    stacks[";".join([f"task {task.get_name()}", *stack])] += 1
+            time.sleep(interval)
+        log.info("profile(): Took samples of %d stacks", len(stacks))
+        return to_collapsed(stacks)
+    finally:
+        _profile_lock.release()
+
+
+def _run_watchdog() -> None:
+    """Sample the tracked calls running past the threshold, forever."""
+    while True:
+        _calls_active.wait()
+        time.sleep(get_interval())
+        threshold = get_slow_threshold()
+        now = time.perf_counter()
+        with _lock:
+            slow = [c for c in _calls.values() if now - c.start > threshold]
+        if len(slow) == 0:
+            continue
+        frames = sys._current_frames()
+        stacks = [_format_stack(frames, c.thread_id, c.task) for c in slow]
+        with _lock:
+            for call, stack in zip(slow, stacks, strict=True):
+                # Skip calls that stopped meanwhile, their profile is taken
+                if stack is not None and id(call) in _calls:
+                    call.stacks[stack] += 1
+
+
+def _get_current_task() -> asyncio.Task | None:
+    try:
+        return asyncio.current_task()
+    except RuntimeError:
+        # Not called from a coroutine, e.g. in a worker thread
+        return None
+
+
+def start(name: str) -> int | None:
+    """Start tracking a call, returning a handle for `stop()`.
+
+    Returns None if recording slow calls is disabled.
+    """
+    global _watchdog
+    if get_slow_threshold() <= 0:
+        return None
+    call = _TrackedCall(
+        name, threading.get_ident(), _get_current_task(), datetime.now()
+    )
+    with _lock:
+        if _watchdog is None:
+            _watchdog = threading.Thread(
+                target=_run_watchdog, name="profiling-watchdog", daemon=True
+            )
+            _watchdog.start()
+        _calls[id(call)] = call
+        _calls_active.set()
+    return id(call)
+
+
+def stop(handle: int | None) -> None:
+    """Stop tracking a call, keeping its profile if it was slow."""
+    if handle is None:
+        return
+    with _lock:
+        call = _calls.pop(handle, None)
+        if len(_calls) == 0:
+            _calls_active.clear()
+    if call is None:
+        return
+    duration = time.perf_counter() - call.start
+    if duration > get_slow_threshold():
+        log.warning("Slow call %s took %.2fs", call.name, duration)
+        _get_slow_calls().appendleft(
+            SlowCall(
+                name=call.name,
+                started_at=call.started_at,
+                duration=duration,
+                samples=call.stacks.total(),
+                profile=to_collapsed(call.stacks),
+            )
+        )
+
+
+@contextmanager
+def track(name: str) -> Iterator[None]:
+    """Track a call, keeping its profile if it runs past the threshold."""
+    handle = start(name)
+    try:
+        yield
+    finally:
+        stop(handle)
+
+
+def get_slow_calls() -> list[SlowCall]:
+    """Get the recorded slow calls, most recent first."""
+    return list(_get_slow_calls())
+
+
+def track_requests(app: ASGIApp) -> ASGIApp:
+    """Wrap an ASGI app to track each HTTP request until its response is sent.
+
+    Background tasks run after the response are not part of the request.
+    Requests to `/admin` are not tracked, as profiling takes a while.
+    """
+
+    async def tracked_app(scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"].startswith("/admin"):
+            await app(scope, receive, send)
+            return
+        handle = start(f"{scope['method']} {scope['path']}")
+
+        async def send_and_stop(message: Message) -> None:
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get(
+                "more_body", False
+            ):
+                stop(handle)
+
+        try:
+            await app(scope, receive, send_and_stop)
+        finally:
+            stop(handle)
+
+    return tracked_app
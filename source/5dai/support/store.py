@@ -1,9 +1,30 @@
-"""Functions for utilising the SQLite database."""
+"""Functions for utilising the SQLite database.
+
+Task data is spread over a number of shard databases, set by
+`APP_SQLITE_SHARDS`. A catalog database allocates globally unique task IDs
+and records which shard holds each task, so that tasks can be moved
+between shards while the service is running.
+
+Collections of documents shared by many tasks live in the catalog, with a
+table per shard linking tasks to them.
+
+Routes of tasks to shards are cached per process. Since a task can be moved
+by `reshard` meanwhile, a cached route is only trusted once the task is
+found in the shard, and writers look for it while holding the write lock of
+the shard, so that it cannot be moved away before they commit.
+
+Connections are kept open per thread and reused, which avoids reopening the
+database files and checkpointing the WAL on every operation. Use them as
+context managers to commit or roll back, and do not close them.
+"""
 import logging as log
+import os
 import sqlite3
-from contextlib import closing
+import threading
+from collections.abc import Iterator
+from contextlib import closing, contextmanager
 
-from .paths import get_sqlite_file_path
+from .paths import get_catalog_file_path, get_sqlite_file_path
 
 SQL_CREATE_TASKS_TABLE = """
 CREATE TABLE IF NOT EXISTS tasks (
@@ -38,17 +59,286 @@ CREATE TABLE IF NOT EXISTS task_files (
 )
 """
 
+SQL_CREATE_TASK_CONVERSATIONS_FTS_TABLE = """
+CREATE VIRTUAL TABLE IF NOT EXISTS task_conversations_fts USING fts5 (
+    question,
+    answer,
+    content = 'task_conversations',
+    content_rowid = 'id'
+)
+"""
 
-def init_database() -> None:
-    """Initialize the database."""
-    with closing(
-        sqlite3.connect(
-            get_sqlite_file_path(),
-            detect_types=sqlite3.PARSE_DECLTYPES,
-            check_same_thread=False,
+SQL_CREATE_TASK_CONVERSATIONS_FTS_TRIGGERS = (
+    """
+CREATE TRIGGER IF NOT EXISTS task_conversations_fts_insert
+AFTER INSERT ON task_conversations BEGIN
+    INSERT INTO task_conversations_fts (rowid, question, answer)
+    VALUES (new.id, new.question, new.answer);
+END
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS task_conversations_fts_delete
+AFTER DELETE ON task_conversations BEGIN
+    INSERT INTO task_conversations_fts (task_conversations_fts, rowid, question, answer)
+    VALUES ('delete', old.id, old.question, old.answer);
+END
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS task_conversations_fts_update
+AFTER UPDATE ON task_conversations BEGIN
+    INSERT INTO task_conversations_fts (task_conversations_fts, rowid, question, answer)
+    VALUES ('delete', old.id, old.question, old.answer);
+    INSERT INTO task_conversations_fts (rowid, question, answer)
+    VALUES (new.id, new.question, new.answer);
+END
+""",
+)
+
+# Text extracted from uploaded files, keyed by task_files.id
+SQL_CREATE_TASK_FILES_FTS_TABLE = """
+CREATE VIRTUAL TABLE IF NOT EXISTS task_files_fts USING fts5 (
+    name,
+    content
+)
+"""
+
+SQL_CREATE_TASK_FILES_FTS_TRIGGERS = (
+    """
+CREATE TRIGGER IF NOT EXISTS task_files_fts_delete
+AFTER DELETE ON task_files BEGIN
+    DELETE FROM task_files_fts WHERE rowid = old.id;
+END
+""",
+)
+
+SQL_CREATE_TASK_COLLECTIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS task_collections (
+    task_id INTEGER NOT NULL,
+    collection_id INTEGER NOT NULL,
+    PRIMARY KEY (task_id, collection_id),
+    FOREIGN KEY (task_id) REFERENCES tasks (id)
+)
+"""
+
+SQL_CREATE_COLLECTIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS collections (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+SQL_CREATE_COLLECTION_FILES_TABLE = """
+CREATE TABLE IF NOT EXISTS collection_files (
+    id INTEGER PRIMARY KEY,
+    collection_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    content_type TEXT NOT NULL,
+    uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (collection_id) REFERENCES collections (id)
+)
+"""
+
+SQL_CREATE_TASK_SHARDS_TABLE = """
+CREATE TABLE IF NOT EXISTS task_shards (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    shard INTEGER NOT NULL
+)
+"""
+
+
+def get_shard_count() -> int:
+    """Get the number of shards new tasks are spread over."""
+    return max(1, int(os.getenv("APP_SQLITE_SHARDS", "1")))
+
+
+_local = threading.local()
+
+# Cached routes of tasks to shards, see `get_task_shard()`
+_routes: dict[int, int] = {}
+ROUTES_CACHE_SIZE = 100_000
+
+
+def _open(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(
+        path,
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        check_same_thread=False,
+        timeout=30,
+    )
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    return connection
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    connections = _local.__dict__.setdefault("connections", {})
+    if path not in connections:
+        connections[path] = _open(path)
+    return connections[path]
+
+
+def connect_catalog() -> sqlite3.Connection:
+    """Connect to the catalog database."""
+    return _connect(get_catalog_file_path())
+
+
+def connect_shard(shard: int) -> sqlite3.Connection:
+    """Connect to a shard database."""
+    return _connect(get_sqlite_file_path(shard))
+
+
+def _cache_route(id_: int, shard: int) -> None:
+    if len(_routes) >= ROUTES_CACHE_SIZE:
+        _routes.clear()
+    _routes[id_] = shard
+
+
+def _read_task_shard(id_: int) -> int:
+    with closing(connect_catalog().cursor()) as cursor:
+        row = cursor.execute(
+            "SELECT shard FROM task_shards WHERE id = ?", (id_,)
+        ).fetchone()
+    shard = row[0] if row else id_ % get_shard_count()
+    _cache_route(id_, shard)
+    return shard
+
+
+def get_task_shard(id_: int) -> int:
+    """Get the shard holding a task, as last known by this process.
+
+    Unknown tasks are routed by ID so that lookups simply find nothing.
+    """
+    shard = _routes.get(id_)
+    return shard if shard is not None else _read_task_shard(id_)
+
+
+def _has_task(connection: sqlite3.Connection, id_: int) -> bool:
+    return (
+        connection.execute(
+            "SELECT 1 FROM tasks WHERE id = ?", (id_,)
+        ).fetchone()
+        is not None
+    )
+
+
+def connect_task(id_: int) -> sqlite3.Connection:
+    """Connect to the shard database holding a task, for reading."""
+    shard = get_task_shard(id_)
+    if not _has_task(connect_shard(shard), id_):
+        # Moved meanwhile, or not there at all
+        shard = _read_task_shard(id_)
+    return connect_shard(shard)
+
+
+@contextmanager
+def write_task(id_: int) -> Iterator[sqlite3.Connection]:
+    """Connect to the shard database holding a task, in a write transaction.
+
+    The transaction is committed on exit, or rolled back on error.
+    """
+    shard = get_task_shard(id_)
+    while True:
+        connection = connect_shard(shard)
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if _has_task(connection, id_):
+                break
+            # Moved before the write lock was taken, or not there at all
+            actual = _read_task_shard(id_)
+        except BaseException:
+            # Never leave the shared connection holding the write lock
+            connection.rollback()
+            raise
+        if actual == shard:
+            break
+        connection.rollback()
+        shard = actual
+    with connection:
+        yield connection
+
+
+def allocate_task_ids(count: int) -> list[int]:
+    """Allocate globally unique task IDs at once and assign them shards."""
+    with connect_catalog() as connection, closing(
+        connection.cursor()
+    ) as cursor:
+        ids = []
+        for _ in range(count):
+            cursor.execute("INSERT INTO task_shards (shard) VALUES (-1)")
+            ids.append(cursor.lastrowid)
+        cursor.executemany(
+            "UPDATE task_shards SET shard = ? WHERE id = ?",
+            ((id_ % get_shard_count(), id_) for id_ in ids),
         )
-    ) as connection, closing(connection.cursor()) as cursor:
+    for id_ in ids:
+        _cache_route(id_, id_ % get_shard_count())
+    log.debug("allocate_task_ids(): Allocated ids=%s", ids)
+    return ids
+
+
+def allocate_task_id() -> int:
+    """Allocate a globally unique task ID and assign it a shard."""
+    return allocate_task_ids(1)[0]
+
+
+def release_task_id(id_: int) -> None:
+    """Forget an allocated task ID, once its task is removed or never made."""
+    with connect_catalog() as connection:
+        connection.execute("DELETE FROM task_shards WHERE id = ?", (id_,))
+    _routes.pop(id_, None)
+
+
+def init_shard(shard: int) -> None:
+    """Initialize the tables of a shard database."""
+    with connect_shard(shard) as connection, closing(
+        connection.cursor()
+    ) as cursor:
+        fts_exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'task_conversations_fts'"
+        ).fetchone()
         cursor.execute(SQL_CREATE_TASKS_TABLE)
         cursor.execute(SQL_CREATE_TASK_CONVERSATIONS_TABLE)
         cursor.execute(SQL_CREATE_TASK_FILES_TABLE)
-        log.info("Database initialized")
+        cursor.execute(SQL_CREATE_TASK_COLLECTIONS_TABLE)
+        cursor.execute(SQL_CREATE_TASK_CONVERSATIONS_FTS_TABLE)
+        cursor.execute(SQL_CREATE_TASK_FILES_FTS_TABLE)
+        for sql in (
+            SQL_CREATE_TASK_CONVERSATIONS_FTS_TRIGGERS
+            + SQL_CREATE_TASK_FILES_FTS_TRIGGERS
+        ):
+            cursor.execute(sql)
+        if not fts_exists:
+            # Index conversations stored before full-text search was added
+            cursor.execute(
+                "INSERT INTO task_conversations_fts (task_conversations_fts) VALUES ('rebuild')"
+            )
+
+
+def _register_existing_tasks(shard: int) -> None:
+    """Record tasks of a shard in the catalog, e.g. from before sharding."""
+    with connect_catalog() as catalog:
+        catalog.executemany(
+            "INSERT OR IGNORE INTO task_shards (id, shard) VALUES (?, ?)",
+            (
+                (row[0], shard)
+                for row in connect_shard(shard).execute("SELECT id FROM tasks")
+            ),
+        )
+
+
+def init_database() -> None:
+    """Initialize the database."""
+    catalog_exists = os.path.exists(get_catalog_file_path())
+    with connect_catalog() as connection:
+        connection.execute(SQL_CREATE_TASK_SHARDS_TABLE)
+        connection.execute(SQL_CREATE_COLLECTIONS_TABLE)
+        connection.execute(SQL_CREATE_COLLECTION_FILES_TABLE)
+
+    for shard in range(get_shard_count()):
+        init_shard(shard)
+        if not catalog_exists:
+            _register_existing_tasks(shard)
+    log.info("Database initialized with %d shard(s)", get_shard_count())
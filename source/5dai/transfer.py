@@ -0,0 +1,58 @@
+"""Export tasks to, or import tasks from, NDJSON files.
+
+Usage:
+    `python -m 5dai.transfer export [--ids 1 2] [--no-index] [--output FILE]`
+    `python -m 5dai.transfer import [--reuse-index] [FILE]`
+
+Without a file, export writes to stdout and import reads from stdin.
+"""
+
+import argparse
+import logging as log
+import os
+import sys
+
+from dotenv import load_dotenv
+
+from .services.transfer import export_tasks, import_tasks
+from .support.store import init_database
+
+if __name__ == "__main__":
+    load_dotenv()
+    log.basicConfig(level=os.getenv("APP_LOG_LEVEL", "INFO"))
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="export tasks")
+    export_parser.add_argument(
+        "--ids", type=int, nargs="+", help="tasks to export, default all"
+    )
+    export_parser.add_argument(
+        "--no-index", action="store_true", help="leave out index data"
+    )
+    export_parser.add_argument(
+        "--output", type=argparse.FileType("w"), default=sys.stdout
+    )
+    import_parser = commands.add_parser("import", help="import tasks")
+    import_parser.add_argument(
+        "--reuse-index",
+        action="store_true",
+        help="use exported index data instead of reindexing",
+    )
+    import_parser.add_argument(
+        "input", type=argparse.FileType("r"), nargs="?", default=sys.stdin
+    )
+    args = parser.parse_args()
+
+    init_database()
+    if args.command == "export":
+        with args.output as out_:
+            out_.writelines(export_tasks(args.ids, not args.no_index))
+    else:
+        with args.input as in_:
+            import_ = import_tasks(in_, args.reuse_index)
+        print(f"Imported {import_.tasks} tasks with {import_.files} files")
+        for id_, collection_ids in import_.unlinked_collections.items():
+            print(
+                f"Dropped links of task {id_} to collections {collection_ids}"
+            )